@@ -1,45 +1,309 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, current_app, g, session, make_response
+from flask.cli import with_appcontext
+import click
+import csv
 import datetime
+import functools
+import hashlib
+import io
+import json
 import os
+import sqlite3
+import threading
+import time
+import zlib
 
 from backend import db as dbmod
 from backend import categories as catmod 
 from backend import add_transcations as add_mod 
 from backend import automations as auto_mod
 from backend import sync as sync_mod
+from backend import changelog
 from backend import utils
 from backend import rates
+from backend import aggregates as aggmod
+from backend import search as search_mod
+from backend import importer
+from backend import scheduler as scheduler_mod
+from backend import metrics
+from backend.cache import ResultCache
+
+# how long a request waits for the startup work (sync download + db init) before getting a 503
+STARTUP_TIMEOUT = float(os.environ.get('STARTUP_TIMEOUT', '120'))
+
+# routes and cli commands are collected here and registered by create_app()
+_routes = []
+_commands = []
+
+def route(rule, **options):
+    def decorator(f):
+        _routes.append((rule, f, options))
+        return f
+    return decorator
+
+def command(f):
+    _commands.append(f)
+    return f
 
 # -------------------------
-# app & database setup
+# startup
 # -------------------------
-app = Flask(__name__)
-app.secret_key = os.environ.get('FLASK_SECRET')
-app.config['MAIN_CURRENCY'] = os.environ.get('MAIN_CURRENCY', 'EUR')
-
-# downlaod current database
-download_script = os.environ.get('SYNC_DOWNLOAD_SCRIPT')
-job = sync_mod.run_sync_job(download_script)
-
-# ensure DB exists and automations run on startup (same as CLI main did)
-dbmod.init_db()
-catmod.init_categories_db()
-auto_mod.init_automations_db()
-
-# run automations once on startup to mirror CLI behaviour
-try:
-    auto_mod.update_fix_transactions()
-except Exception as e:
-    # non-fatal, show in logs and continue
-    print('Automations update failed on startup:', e)
+_ready = threading.Event()
+_startup_error = None
+_startup_lock = threading.Lock()
+_startup_thread = None
+# changes whenever startup finished (new process or freshly downloaded database), part of every ETag
+_etag_epoch = ''
+
+def _init_database():
+    """ensure all tables, indexes and triggers exist (safe to call on every start)"""
+    # categories first, expenses and automations reference them
+    catmod.init_categories_db()
+    dbmod.init_db()
+    auto_mod.init_automations_db()
+    aggmod.init_aggregates_db()
+    search_mod.init_search_db()
+    rates.init_rates_db()
+    scheduler_mod.init_scheduler_db()
+    sync_mod.init_sync_db()
+    # last, it adds uids and log triggers to the tables above
+    changelog.init_changelog_db()
+
+def _startup():
+    """download the current database, then prepare it. runs once per process, in the background"""
+    global _startup_error, _etag_epoch
+    try:
+        download = os.environ.get('SYNC_DOWNLOAD_SCRIPT')
+        if download:
+            try:
+                # the old file's WAL must not be replayed onto the downloaded one
+                dbmod.release_for_replace()
+            except sqlite3.Error as e:
+                print('Database busy, using the local version instead of downloading:', e)
+                download = None
+        sync_mod.run_sync_job(download)
+        # the db file may have been replaced, don't keep using connections (or categories) of the old one
+        dbmod.close_all_conns()
+        catmod.invalidate_categories()
+        dashboard_cache.invalidate()
+        analytics_cache.invalidate()
+        _init_database()
+        _etag_epoch = str(time.time_ns())
+    except Exception as e:
+        _startup_error = str(e)
+        print('Startup failed:', e)
+    finally:
+        _ready.set()
+
+def start_background_init():
+    global _startup_thread
+    with _startup_lock:
+        if _startup_thread is None:
+            _startup_thread = threading.Thread(target=_startup, name='startup', daemon=True)
+            _startup_thread.start()
+
+def wait_until_ready(timeout=None):
+    """block until startup finished, returns False on timeout. raises if startup failed"""
+    start_background_init()
+    if not _ready.wait(timeout):
+        return False
+    if _startup_error is not None:
+        raise click.ClickException(f'Startup failed: {_startup_error}')
+    return True
+
+def _readiness_gate():
+    # requests are held until the download sync and db init are done
+    if request.endpoint in ('static', 'metrics_view'):
+        return None
+    if not _ready.is_set() and not _ready.wait(STARTUP_TIMEOUT):
+        return Response('Starting up, please retry in a moment.', status=503, headers={'Retry-After': '5'})
+    if _startup_error is not None:
+        # the database may be half-initialized or the download failed, don't serve from it
+        return Response('Startup failed, the database is not available. See the server log.', status=503)
+    return None
+
+def _start_scheduler():
+    # automations run in a background thread (daily at AUTOMATIONS_RUN_AT and after edits),
+    # started with the first request after startup so importing the app or running cli commands stays cheap
+    if _ready.is_set() and _startup_error is None and current_app.config['START_SCHEDULER']:
+        scheduler_mod.start()
+
+def _metrics_begin():
+    metrics.begin_request()
+
+def _metrics_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+def _metrics_end(exc):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = 500 if exc is not None else g.get('metrics_status', 500)
+    metrics.end_request(route, request.method, status)
+
+def create_app(config=None):
+    """config: optional dict of settings, e.g. {'START_SCHEDULER': False} for benchmarks"""
+    app = Flask(__name__)
+    app.secret_key = os.environ.get('FLASK_SECRET')
+    app.config['MAIN_CURRENCY'] = os.environ.get('MAIN_CURRENCY', 'EUR')
+    app.config['START_SCHEDULER'] = True
+    app.config.update(config or {})
+
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for cmd in _commands:
+        app.cli.add_command(cmd)
+
+    if metrics.ENABLED:
+        # first, so time spent waiting at the readiness gate is part of the request
+        app.before_request(_metrics_begin)
+        app.after_request(_metrics_status)
+        app.teardown_request(_metrics_end)
+    app.before_request(_readiness_gate)
+    app.before_request(_start_scheduler)
+
+    start_background_init()
+    return app
+
+# -------------------------
+# cli
+# -------------------------
+@command
+@click.command('rebuild-aggregates')
+@with_appcontext
+def rebuild_aggregates_command():
+    """recompute the dashboard summary tables from all transactions"""
+    wait_until_ready()
+    n = aggmod.rebuild_aggregates()
+    print(f'Rebuilt aggregates: {n} daily rows')
+
+@command
+@click.command('import-csv')
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--map', 'mappings', multiple=True, metavar='FIELD=COLUMN',
+              help='csv column for date, description, amount, category, currency or is_expense')
+@click.option('--date-format', default='%Y-%m-%d', show_default=True)
+@click.option('--delimiter', default=',', show_default=True)
+@click.option('--decimal', default='.', show_default=True, type=click.Choice(['.', ',']))
+@click.option('--currency', default=None, help='currency of the amounts if the file has no currency column')
+@click.option('--encoding', default='utf-8-sig', show_default=True)
+@with_appcontext
+def import_csv_command(csv_path, mappings, date_format, delimiter, decimal, currency, encoding):
+    """import a bank statement csv into the transactions"""
+    wait_until_ready()
+    mapping = {}
+    for m in mappings:
+        field, _, column = m.partition('=')
+        mapping[field.strip()] = column.strip() or None
+
+    def progress(n, seconds):
+        print(f'\r{n} rows imported ({n / seconds if seconds else 0:.0f} rows/s)', end='', flush=True)
+
+    with open(csv_path, newline='', encoding=encoding) as f:
+        report = importer.import_csv(f, mapping, main_currency=current_app.config['MAIN_CURRENCY'], default_currency=currency,
+                                     date_format=date_format, delimiter=delimiter, decimal=decimal, progress=progress)
+    print(f"\nImported {report['imported']} rows, skipped {report['skipped']} in {report['seconds']}s ({report['rows_per_sec']} rows/s)")
+    for err in report['errors']:
+        print('  ' + err)
+
+@command
+@click.command('prefetch-rates')
+@click.option('--base', 'bases', multiple=True, required=True, help='currency to fetch rates for, repeatable')
+@click.option('--start', 'start', required=True, help='first day, YYYY-MM-DD')
+@click.option('--end', 'end', default=None, help='last day, YYYY-MM-DD (default today)')
+@click.option('--workers', default=rates.PREFETCH_WORKERS, show_default=True)
+@with_appcontext
+def prefetch_rates_command(bases, start, end, workers):
+    """backfill the exchange rate store for a date range"""
+    wait_until_ready()
+    first = datetime.date.fromisoformat(start)
+    last = datetime.date.fromisoformat(end) if end else datetime.date.today()
+    days = [(first + datetime.timedelta(days=i)).isoformat() for i in range((last - first).days + 1)]
+    report = rates.prefetch([(b, d) for b in bases for d in days], max_workers=workers)
+    print(f"cached: {report['cached']}, fetched: {report['fetched']}, failed: {len(report['failed'])}")
+
+@command
+@click.command('sync-export')
+@click.argument('out_path', type=click.Path(dir_okay=False))
+@click.option('--peer', default=None, help='device id of the receiving database: only changes it has not confirmed yet')
+@click.option('--since', type=int, default=None, help='changes after this sequence number instead')
+@with_appcontext
+def sync_export_command(out_path, peer, since):
+    """write the changed rows to a changeset file (.json or .json.gz) for another device"""
+    wait_until_ready()
+    changeset = changelog.export_changes(peer, since)
+    changelog.write_changeset(out_path, changeset)
+    print(f"{len(changeset['changes'])} changes (seq {changeset['since']}..{changeset['until']}) from {changeset['device']} written to {out_path}")
+
+@command
+@click.command('sync-apply')
+@click.argument('in_path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def sync_apply_command(in_path):
+    """apply a changeset file exported by another device"""
+    wait_until_ready()
+    changeset = changelog.read_changeset(in_path)
+    try:
+        report = changelog.apply_changes(changeset)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"applied {report['applied']}, skipped {report['skipped']} older changes from {changeset['device']}")
+    for conflict in report['conflicts']:
+        print('  not applied: ' + conflict)
+
+@command
+@click.command('sync-device')
+@click.option('--reset', is_flag=True, help='new device id, for a database that started as a copy of another one')
+@with_appcontext
+def sync_device_command(reset):
+    """show this database's device id and the peers it exchanged changes with"""
+    wait_until_ready()
+    print('device:', changelog.new_device_id() if reset else changelog.device_id())
+    for p in changelog.list_peers():
+        print(f"peer {p['device_id']}: received up to {p['received_seq']}, confirmed sent up to {p['sent_seq']}, last sync {p['last_sync']}")
 
 # -------------------------
 # routes
 # -------------------------
 
+# ---- conditional get ----
+def _etag(kind):
+    """
+    etag of a page: the write sequence (any change to the data) + normalized query args.
+    today's date is part of it too, the default time filter is the current month
+    """
+    args = sorted((k, v.strip()) for k, v in request.args.items(multi=True) if v.strip() != '')
+    key = json.dumps([kind, _etag_epoch, dbmod.write_seq(), args, datetime.date.today().isoformat(),
+                      current_app.config['MAIN_CURRENCY']])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def conditional(kind):
+    """answer GETs with 304 when the client's If-None-Match is still current, before the view runs"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # flashed messages are shown once, a page that has some can't be served from cache
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+            etag = _etag(kind)
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
+            else:
+                resp = make_response(view(*args, **kwargs))
+            # errors (e.g. a bad query arg) get no etag, a client must not revalidate them into a 304
+            if resp.status_code in (200, 304):
+                resp.set_etag(etag)
+                # always revalidate, the etag check is what makes it cheap
+                resp.headers['Cache-Control'] = 'no-cache'
+            return resp
+        return wrapper
+    return decorator
+
 # ---- main page ----
-@app.route('/')
-def index():
+def _index_filter_from_request():
+    """
+    parse the index page query args (time, search_*, order) into the SQL filter.
+    shared by the index page and /export, returns a dict
+    """
     time = request.args.get('time', '') # (YYYY, YYYY-MM, YYYY-MM-DD, or 'all')
     order = request.args.get('order', 'date')
 
@@ -121,13 +385,15 @@ def index():
         year = month = day = None
         params.append(search_id)
     if search_amount:
-        addon += ' AND ((amount BETWEEN ? AND ?) OR (amount BETWEEN ? AND ?)) '
-        params.extend([float(search_amount) - 1, float(search_amount) + 1, -float(search_amount) - 1, -float(search_amount) + 1])
+        amount_sql, amount_params = utils.amount_filter(search_amount)
+        addon += amount_sql
+        params.extend(amount_params)
     if search_desc:
-        addon += ' AND description LIKE ?'
-        params.append(f'%{search_desc}%')
+        desc_sql, desc_params = search_mod.description_filter(search_desc)
+        addon += desc_sql
+        params.extend(desc_params)
     if search_cate:
-        addon += ' AND category LIKE ?'
+        addon += ' AND category_id IN (SELECT id FROM categories WHERE name LIKE ?)'
         params.append(f'%{search_cate}%')
 
     # --- VISUALIZATION PARAM ---
@@ -142,42 +408,134 @@ def index():
         eff_month = month or now.month
         effective_time = f"{eff_year}-{eff_month:02d}"
 
-    where_clause, duration = utils.get_where_clause('WHERE 1=1 ', year, month, day, total)
+    where_clause, time_params, duration = utils.get_where_clause('WHERE 1=1 ', year, month, day, total)
     where_clause += addon
+    params = time_params + params
 
     # --- SORTING ---
     order_value = 'date'
     if order in ('amount', 'category', 'description', 'id'):
         order_value = order
+    # best description matches first, only meaningful while searching
+    match = None
+    if order == 'relevance' and search_desc:
+        match = search_mod.relevance_match(search_desc)
+        if match is not None:
+            order_value = 'relevance'
+
+    return {
+        'time': time, 'order': order, 'duration': duration, 'effective_time': effective_time,
+        'search_id': search_id, 'search_amount': search_amount, 'search_desc': search_desc, 'search_cate': search_cate,
+        'where_clause': where_clause, 'params': tuple(params), 'order_value': order_value, 'match': match,
+    }
+
+@route('/')
+@conditional('index')
+def index():
+    f = _index_filter_from_request()
+    where_clause, params = f['where_clause'], f['params']
+
+    # --- PAGINATION ---
+    try:
+        page_size = int(request.args.get('page_size', dbmod.PAGE_SIZE))
+    except ValueError:
+        page_size = dbmod.PAGE_SIZE
+    page_size = max(1, min(page_size, dbmod.MAX_PAGE_SIZE))
+    after = utils.decode_cursor(request.args.get('after', ''))
 
     # --- QUERY ---
-    txs = dbmod.query_transactions(where_clause=where_clause, params=tuple(params), order_by=order_value)
-    total_amount = dbmod.sum_query(where_clause=where_clause, params=tuple(params))
+    txs, next_after = dbmod.query_transactions_page(where_clause=where_clause, params=params,
+                                                    order_by=f['order_value'], page_size=page_size, after=after, match=f['match'])
+    # totals always cover the whole filter, not only the shown page
+    summary = dbmod.summary_query(where_clause=where_clause, params=params)
+    total_amount = summary['total']
 
-    # build a case-insensitive mapping name -> emoji for fast lookup in template
-    cats = catmod.list_categories_with_ids()
-    cat_emoji_map = {}
-    for c in cats:
-        if c.get('name') is None:
-            continue
-        cat_emoji_map[c['name'].lower()] = c.get('emoji') or ''
+    # links keep all current query args and only swap the cursor
+    page_args = request.args.to_dict()
+    page_args.pop('after', None)
+    next_url = url_for('index', **page_args, after=utils.encode_cursor(next_after)) if next_after else None
+    first_url = url_for('index', **page_args) if after else None
+
+    # case-insensitive mapping name -> emoji for fast lookup in template (cached, no query)
+    cat_emoji_map = catmod.category_emoji_map()
 
     # pass to template
     return render_template('index.html',
                         transactions=txs,
                         total=round(total_amount, 2),
-                        duration=duration,
-                        order=order,
-                        time=time,
-                        search_id=search_id,
-                        search_amount=search_amount,
-                        search_desc=search_desc,
-                        search_cate=search_cate,
-                        effective_time=effective_time,
-                        cat_emoji_map=cat_emoji_map)
+                        duration=f['duration'],
+                        order=f['order'],
+                        time=f['time'],
+                        search_id=f['search_id'],
+                        search_amount=f['search_amount'],
+                        search_desc=f['search_desc'],
+                        search_cate=f['search_cate'],
+                        effective_time=f['effective_time'],
+                        cat_emoji_map=cat_emoji_map,
+                        tx_count=summary['count'],
+                        next_url=next_url,
+                        first_url=first_url)
+
+# ---- export ----
+EXPORT_COLUMNS = ('id', 'date', 'description', 'amount', 'category', 'is_expense')
+
+def _export_lines(rows, fmt):
+    """yield the export file in chunks of a few hundred rows"""
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    for n, r in enumerate(rows, start=1):
+        if writer:
+            writer.writerow([r[c] for c in EXPORT_COLUMNS])
+        else:
+            buf.write(json.dumps({c: r[c] for c in EXPORT_COLUMNS}, ensure_ascii=False) + '\n')
+        if n % 500 == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def _gzip_chunks(chunks):
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        data = gz.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield gz.flush()
+
+@route('/export')
+def export():
+    """
+    stream the transactions matching the index page filters as csv or ndjson.
+    ?format=csv|ndjson, ?gzip=1 downloads a .gz file, otherwise the response is
+    gzip encoded on the fly when the client accepts it
+    """
+    f = _index_filter_from_request()
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt in ('jsonl', 'json'):
+        fmt = 'ndjson'
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'ok': False, 'error': 'format must be csv or ndjson'}), 400
+
+    rows = dbmod.iter_transactions(f['where_clause'], f['params'], order_by=f['order_value'], match=f['match'])
+    body = _export_lines(rows, fmt)
+
+    filename = f'transactions.{fmt}'
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    headers = {}
+    if request.args.get('gzip') == '1':
+        body, filename, mimetype = _gzip_chunks(body), filename + '.gz', 'application/gzip'
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = _gzip_chunks(body)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    headers['Content-Disposition'] = f'attachment; filename={filename}'
+
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
 
 # ---- add transaction ----
-@app.route('/add', methods=['GET', 'POST'])
+@route('/add', methods=['GET', 'POST'])
 def add():
     today = datetime.date.today()
     today_date = today.strftime('%Y-%m-%d')
@@ -189,7 +547,7 @@ def add():
         'amount': '',
         'category': '',
         'is_expense': '1',
-        'currency': app.config['MAIN_CURRENCY']
+        'currency': current_app.config['MAIN_CURRENCY']
     }
 
     if request.method == 'POST':
@@ -199,7 +557,7 @@ def add():
         form['amount'] = request.form.get('amount', '').strip()
         form['category'] = request.form.get('category', '').strip()
         form['is_expense'] = request.form.get('is_expense', '1')
-        form['currency'] = request.form.get('currency', app.config['MAIN_CURRENCY']).strip().lower()
+        form['currency'] = request.form.get('currency', current_app.config['MAIN_CURRENCY']).strip().lower()
 
 
         # validate amount
@@ -253,7 +611,7 @@ def add():
     return render_template('add_edit.html', tx=None, today_date=today_date, errors=errors, form=form)
 
 # ---- edit transaction ----
-@app.route('/edit/<int:tx_id>', methods=['GET', 'POST'])
+@route('/edit/<int:tx_id>', methods=['GET', 'POST'])
 def edit(tx_id):
     today = datetime.date.today()
     today_date = today.strftime('%Y-%m-%d')
@@ -266,7 +624,7 @@ def edit(tx_id):
     # convert tx row to dict for default form values
     tx_dict = dict(tx)
 
-    main_ccy = app.config.get('MAIN_CURRENCY', 'EUR').strip().lower()
+    main_ccy = current_app.config.get('MAIN_CURRENCY', 'EUR').strip().lower()
     displayed_amount = abs(float(tx_dict.get('amount', 0)))
 
     form = {
@@ -275,7 +633,7 @@ def edit(tx_id):
         'amount': str(displayed_amount),
         'category': tx_dict.get('category', ''),
         'is_expense': str(tx_dict.get('is_expense', 1)),
-        'currency': tx_dict.get('currency', app.config['MAIN_CURRENCY'].strip().lower()) 
+        'currency': tx_dict.get('currency', current_app.config['MAIN_CURRENCY'].strip().lower()) 
     }
     errors = {}
 
@@ -289,7 +647,7 @@ def edit(tx_id):
         form['amount'] = request.form.get('amount', '').strip()
         form['category'] = request.form.get('category', '').strip() or form['category']
         form['is_expense'] = request.form.get('is_expense', form['is_expense'])
-        form['currency'] = request.form.get('currency', app.config['MAIN_CURRENCY']).strip().lower()
+        form['currency'] = request.form.get('currency', current_app.config['MAIN_CURRENCY']).strip().lower()
 
         # validate amount
         try:
@@ -340,8 +698,8 @@ def edit(tx_id):
         with dbmod.get_conn() as conn:
             c = conn.cursor()
             try:
-                c.execute("""UPDATE expenses SET date=?, description=?, amount=?, category=?, is_expense=? WHERE id=?""",
-                            (form['date'], form['description'], stored_amount, form['category'], 1 if is_exp else 0, tx_id))
+                c.execute("""UPDATE expenses SET date=?, description=?, amount_cents=?, category_id=?, is_expense=? WHERE id=?""",
+                            (form['date'], form['description'], dbmod.to_cents(stored_amount), catmod.category_id_for(form['category']), 1 if is_exp else 0, tx_id))
                 conn.commit()
                 flash('Transaction updated', 'success')
                 return redirect(redirect_url or url_for('index'))
@@ -356,7 +714,7 @@ def edit(tx_id):
     return render_template('add_edit.html', tx=tx_display, errors=errors, redirect_url=request.referrer or url_for('index'))
 
 # ---- delete transaction ----
-@app.route('/delete/<int:tx_id>', methods=['POST'])
+@route('/delete/<int:tx_id>', methods=['POST'])
 def delete(tx_id):
     try:
         with dbmod.get_conn() as conn:
@@ -372,7 +730,7 @@ def delete(tx_id):
     return redirect(request.referrer or url_for('index'))
 
 
-@app.route('/transaction/<int:tx_id>')
+@route('/transaction/<int:tx_id>')
 def transaction(tx_id):
     tx = dbmod.get_transaction(tx_id)
     if not tx:
@@ -382,8 +740,42 @@ def transaction(tx_id):
     txd['amount'] = abs(txd['amount'])
     return render_template('add_edit.html', tx=txd, view_only=True)
 
+# ---- csv import ----
+@route('/import', methods=['GET', 'POST'])
+def import_view():
+    form = {
+        'date': 'date', 'description': 'description', 'amount': 'amount',
+        'category': '', 'currency': '', 'is_expense': '',
+        'date_format': '%Y-%m-%d', 'delimiter': ',', 'decimal': '.', 'default_currency': current_app.config['MAIN_CURRENCY']
+    }
+    report = None
+
+    if request.method == 'POST':
+        for key in form:
+            form[key] = request.form.get(key, form[key]).strip() if key != 'delimiter' else request.form.get(key, ',')
+        upload = request.files.get('file')
+        if not upload or upload.filename == '':
+            flash('Choose a csv file to import', 'warning')
+            return render_template('import.html', form=form, report=report)
+
+        mapping = {f: (form[f] or None) for f in importer.DEFAULT_MAPPING}
+        if form['delimiter'] == '\\t':
+            form['delimiter'] = '\t'
+        try:
+            # read the upload as a text stream, rows are parsed one by one
+            stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+            report = importer.import_csv(stream, mapping, main_currency=current_app.config['MAIN_CURRENCY'],
+                                         default_currency=form['default_currency'] or None,
+                                         date_format=form['date_format'], delimiter=form['delimiter'] or ',',
+                                         decimal=form['decimal'] or '.')
+            flash(f"Imported {report['imported']} transactions ({report['rows_per_sec']} rows/s)", 'success')
+        except Exception as e:
+            flash(f'Import failed: {e}', 'danger')
+
+    return render_template('import.html', form=form, report=report)
+
 # ---- automations ----
-@app.route('/automations', methods=['GET', 'POST'])
+@route('/automations', methods=['GET', 'POST'])
 def automations_view():
     if request.method == 'POST':
         action = request.form.get('action')
@@ -397,24 +789,29 @@ def automations_view():
                 request.form.get('start', ''),
                 request.form.get('end', '')
             )
+            scheduler_mod.trigger()
             flash('Automation added', 'success')
         elif action == 'run':
-            auto_mod.update_fix_transactions()
-            flash('Automations executed', 'success')
+            if scheduler_mod.run_automations():
+                flash('Automations executed', 'success')
+            else:
+                flash('Automations are already running', 'warning')
         return redirect(url_for('automations_view'))
 
     automations = auto_mod.list_automations()
-    return render_template('automations.html', automations=automations)
+    return render_template('automations.html', automations=automations,
+                           run_status=scheduler_mod.status('automations'), next_run=scheduler_mod.next_run())
 
-@app.route('/automations/delete/<int:aid>', methods=['POST'])
+@route('/automations/delete/<int:aid>', methods=['POST'])
 def automation_delete(aid):
     if auto_mod.delete_automation(aid):
+        scheduler_mod.trigger()
         flash('Automation deleted', 'success')
     else:
         flash('Automation not found', 'danger')
     return redirect(url_for('automations_view'))
 
-@app.route('/automations/edit/<int:aid>', methods=['GET', 'POST'])
+@route('/automations/edit/<int:aid>', methods=['GET', 'POST'])
 def automation_edit(aid):
     automation = auto_mod.get_automation_by_id(aid)
     if not automation:
@@ -432,18 +829,19 @@ def automation_edit(aid):
             'end': request.form.get('end', '')
         }
         auto_mod.update_automation(aid, new_data)
+        scheduler_mod.trigger()
         flash('Automation updated', 'success')
         return redirect(url_for('automations_view'))
 
     return render_template('automation_edit.html', automation=automation, aid=aid)
 
 # ---- categories ----
-@app.route('/categories')
+@route('/categories')
 def categories():
     cats = catmod.list_categories_with_ids()
     return render_template('categories.html', categories=cats)
 
-@app.route('/categories/add', methods=['POST'])
+@route('/categories/add', methods=['POST'])
 def add_category():
     name = request.form.get('name','').strip()
     emoji = request.form.get('emoji', '').strip() or None
@@ -454,7 +852,7 @@ def add_category():
     flash('Category added', 'success')
     return redirect(url_for('categories'))
 
-@app.route('/categories/<int:cat_id>/edit', methods=['POST'])
+@route('/categories/<int:cat_id>/edit', methods=['POST'])
 def edit_category(cat_id):
     new_name = request.form.get('name','').strip()
     new_emoji = request.form.get('emoji','').strip() or None
@@ -465,13 +863,13 @@ def edit_category(cat_id):
     flash('Category updated' if ok else 'Update failed', 'success' if ok else 'danger')
     return redirect(url_for('categories'))
 
-@app.route('/categories/<int:cat_id>/delete', methods=['POST'])
+@route('/categories/<int:cat_id>/delete', methods=['POST'])
 def delete_category(cat_id):
     ok = catmod.delete_category(cat_id)
     flash('Category deleted' if ok else 'Delete failed', 'success' if ok else 'danger')
     return redirect(url_for('categories'))
 
-@app.route('/categories/<int:cat_id>/keywords/add', methods=['POST'])
+@route('/categories/<int:cat_id>/keywords/add', methods=['POST'])
 def add_keyword(cat_id):
     kw = request.form.get('keyword','').strip()
     if not kw:
@@ -481,7 +879,7 @@ def add_keyword(cat_id):
         flash('Keyword added', 'success')
     return redirect(url_for('categories'))
 
-@app.route('/categories/keywords/<int:kw_id>/delete', methods=['POST'])
+@route('/categories/keywords/<int:kw_id>/delete', methods=['POST'])
 def delete_keyword(kw_id):
     ok = catmod.delete_keyword(kw_id)
     flash('Keyword removed' if ok else 'Keyword delete failed', 'success' if ok else 'danger')
@@ -557,10 +955,22 @@ def _parse_time_from_arg(time_str, default_total_if_empty=False):
     return year, month, day, total
 
 
-def _build_where_and_params_from_request(default_total_if_empty=False):
+def _bad_search_id():
+    """400 response if search_id is given but not a number, the data endpoints look it up as an integer id"""
+    search_id = request.args.get('search_id', '').strip()
+    if not search_id:
+        return None
+    try:
+        int(search_id)
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'search_id must be a number'}), 400
+    return None
+
+def _build_where_and_params_from_request(default_total_if_empty=False, lookback_days=0):
     """
     build SQL WHERE clause + params tuple from request args
     default_total_if_empty: if True, an empty time param becomes 'all time' for the dashboard.
+    lookback_days: start the time range that many days earlier (warm-up rows for rolling windows).
     """
     time = request.args.get('time', '')
     search_id = request.args.get('search_id', '').strip()
@@ -570,42 +980,56 @@ def _build_where_and_params_from_request(default_total_if_empty=False):
 
     year, month, day, total = _parse_time_from_arg(time, default_total_if_empty=default_total_if_empty)
 
-    where_clause, duration = utils.get_where_clause('WHERE 1=1 ', year, month, day, total)
-
-    params = []
+    where_clause, params, duration = utils.get_where_clause('WHERE 1=1 ', year, month, day, total)
+    if lookback_days and params:
+        # params start with the range (start, end) bound by get_where_clause
+        params[0] = (datetime.date.fromisoformat(params[0]) - datetime.timedelta(days=lookback_days)).isoformat()
 
     # if search_id present, ignore time filter and look up exact id
     if search_id:
         where_clause = 'WHERE id = ?'
-        params.append(int(search_id))
+        params = [int(search_id)]
         # if searching by id we intentionally ignore other search fields
         return where_clause, tuple(params), duration
 
-    # for amount: use absolute value to match both positive and negative stored amounts
+    # same amount match as the index page, both signs within the tolerance
     if search_amount:
-        try:
-            amt_val = float(search_amount)
-            where_clause += ' AND ABS(amount) = ?'
-            params.append(amt_val)
-        except ValueError:
-            # ignore invalid amount on server side (no match)
-            where_clause += ' AND 0 = 1'  # force empty result set
+        amount_sql, amount_params = utils.amount_filter(search_amount)
+        where_clause += amount_sql
+        params.extend(amount_params)
     if search_desc:
-        where_clause += ' AND description LIKE ?'
-        params.append(f'%{search_desc}%')
+        desc_sql, desc_params = search_mod.description_filter(search_desc)
+        where_clause += desc_sql
+        params.extend(desc_params)
     if search_cate:
-        where_clause += ' AND category LIKE ?'
+        where_clause += ' AND category_id IN (SELECT id FROM categories WHERE name LIKE ?)'
         params.append(f'%{search_cate}%')
 
     return where_clause, tuple(params), duration
 
-@app.route('/dashboard')
+@route('/dashboard')
 def dashboard():
     # the template will fetch /dashboard/data (and pass the query string)
     return render_template('dashboard.html')
 
-@app.route('/dashboard/data')
+# computed dashboard payloads, reused until the next write (see db.write_seq)
+dashboard_cache = ResultCache('dashboard', maxsize=int(os.environ.get('DASHBOARD_CACHE_SIZE', '128')))
+
+@route('/dashboard/data')
+@conditional('dashboard')
 def dashboard_data():
+    error = _bad_search_id()
+    if error:
+        return error
+    # identical requests (other tabs, other users) share one computation per data version
+    payload = dashboard_cache.get_or_compute(_cache_key(), _dashboard_payload, version=(_etag_epoch, dbmod.write_seq()))
+    return jsonify(payload)
+
+def _cache_key():
+    args = tuple(sorted((k, v.strip()) for k, v in request.args.items(multi=True) if v.strip() != ''))
+    return (args, datetime.date.today().isoformat())
+
+def _dashboard_payload():
     # read time param raw to decide view granularity
     time = request.args.get('time', '')
     year, month, day, total = _parse_time_from_arg(time, default_total_if_empty=True)
@@ -616,13 +1040,32 @@ def dashboard_data():
     # always limit visuals to expenses (keep behaviour consistent)
     where_expense = where_clause + ' AND is_expense = 1'
 
+    # pure time filters can be answered from the pre-aggregated summary tables,
+    # any search filter needs the raw rows
+    use_aggregates = not any(request.args.get(k, '').strip() for k in ('search_id', 'search_amount', 'search_desc', 'search_cate'))
+    start, end = utils.get_date_range(year, month, day, total)
+
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
 
+        def category_rows():
+            if use_aggregates:
+                return aggmod.category_expense_totals(start, end)
+            cur.execute(f"""
+                SELECT category_id, -SUM(amount_cents) / 100.0 AS total
+                FROM expenses
+                {where_expense}
+                GROUP BY category_id
+                ORDER BY total DESC
+                LIMIT 50
+            """, params)
+            names = catmod.category_names()
+            return [{'category': names.get(r['category_id'], '(none)'), 'total': r['total']} for r in cur.fetchall()]
+
         # if user requested an exact day -> DAILY view: return individual transactions
         if day is not None:
             # where_clause already restricts by that day via get_where_clause
-            q = f'SELECT id, date, description, amount, category FROM expenses {where_expense} ORDER BY date, id'
+            q = f'SELECT id, date, description, amount, category FROM expenses_view {where_expense} ORDER BY date, id'
             cur.execute(q, params)
             rows = cur.fetchall()
             transactions = []
@@ -636,108 +1079,123 @@ def dashboard_data():
                 })
 
             # category distribution for the day
-            q_cats = f"""
-                SELECT COALESCE(category, '(none)') AS category, -SUM(amount) AS total
-                FROM expenses
-                {where_expense}
-                GROUP BY category
-                ORDER BY total DESC
-                LIMIT 50
-            """
-            cur.execute(q_cats, params)
-            cat_rows = cur.fetchall()
-            categories = [{'category': r['category'], 'total': round(float(r['total'] or 0.0), 2)} for r in cat_rows]
+            categories = [{'category': r['category'], 'total': round(float(r['total'] or 0.0), 2)} for r in category_rows()]
 
             empty = (len(transactions) == 0 and len(categories) == 0)
-            return jsonify({
+            return {
                 'view': 'daily',
                 'duration': duration,
                 'transactions': transactions,
                 'categories': categories,
                 'empty': empty
-            })
+            }
 
         # if user requested a month -> show daily totals for that month
         if month is not None and year is not None and not total:
-            q_days = f"""
-                SELECT strftime('%Y-%m-%d', date) AS day, -SUM(amount) AS total
-                FROM expenses
-                {where_expense}
-                GROUP BY day
-                ORDER BY day
-            """
-            cur.execute(q_days, params)
-            day_rows = cur.fetchall()
+            if use_aggregates:
+                day_rows = aggmod.daily_expense_totals(start, end)
+            else:
+                q_days = f"""
+                    SELECT strftime('%Y-%m-%d', date) AS day, -SUM(amount_cents) / 100.0 AS total
+                    FROM expenses
+                    {where_expense}
+                    GROUP BY day
+                    ORDER BY day
+                """
+                cur.execute(q_days, params)
+                day_rows = cur.fetchall()
             labels = [r['day'] for r in day_rows]
             totals = [round(float(r['total'] or 0.0), 2) for r in day_rows]
 
             # categories for that month
-            q_cats = f"""
-                SELECT COALESCE(category, '(none)') AS category, -SUM(amount) AS total
-                FROM expenses
-                {where_expense}
-                GROUP BY category
-                ORDER BY total DESC
-                LIMIT 50
-            """
-            cur.execute(q_cats, params)
-            cat_rows = cur.fetchall()
-            categories = [{'category': r['category'], 'total': round(float(r['total'] or 0.0), 2)} for r in cat_rows]
+            categories = [{'category': r['category'], 'total': round(float(r['total'] or 0.0), 2)} for r in category_rows()]
 
             empty = (len(labels) == 0 and len(categories) == 0)
-            return jsonify({
+            return {
                 'view': 'monthly_by_day',
                 'duration': duration,
                 'labels': labels,
                 'values': totals,
                 'categories': categories,
                 'empty': empty
-            })
+            }
 
         # otherwise: year-only or all-time -> monthly grouping
-        q_months = f"""
-            SELECT strftime('%Y-%m', date) AS ym, -SUM(amount) AS total
-            FROM expenses
-            {where_expense}
-            GROUP BY ym
-            ORDER BY ym
-        """
-        cur.execute(q_months, params)
-        month_rows = cur.fetchall()
+        if use_aggregates:
+            month_rows = aggmod.monthly_expense_totals(start, end)
+        else:
+            q_months = f"""
+                SELECT strftime('%Y-%m', date) AS ym, -SUM(amount_cents) / 100.0 AS total
+                FROM expenses
+                {where_expense}
+                GROUP BY ym
+                ORDER BY ym
+            """
+            cur.execute(q_months, params)
+            month_rows = cur.fetchall()
         months = [r['ym'] for r in month_rows]
         month_totals = [round(float(r['total'] or 0.0), 2) for r in month_rows]
 
         # category distribution for the same filter
-        q_cats = f"""
-            SELECT COALESCE(category, '(none)') AS category, -SUM(amount) AS total
-            FROM expenses
-            {where_expense}
-            GROUP BY category
-            ORDER BY total DESC
-            LIMIT 50
-        """
-        cur.execute(q_cats, params)
-        cat_rows = cur.fetchall()
-        categories = [{'category': r['category'], 'total': round(float(r['total'] or 0.0), 2)} for r in cat_rows]
+        categories = [{'category': r['category'], 'total': round(float(r['total'] or 0.0), 2)} for r in category_rows()]
 
     empty = (len(months) == 0 and len(categories) == 0)
-    return jsonify({
+    return {
         'view': 'monthly',
         'duration': duration,
         'months': months,
         'month_totals': month_totals,
         'categories': categories,
         'empty': empty
-    })
+    }
+
+# ---- analytics ----
+analytics_cache = ResultCache('analytics', maxsize=int(os.environ.get('ANALYTICS_CACHE_SIZE', '128')))
+
+@route('/analytics/data')
+@conditional('analytics')
+def analytics_data():
+    error = _bad_search_id()
+    if error:
+        return error
+    # same filters as the dashboard: rolling spend, month-over-month per category, percentiles, daily burn
+    payload = analytics_cache.get_or_compute(_cache_key(), _analytics_payload, version=(_etag_epoch, dbmod.write_seq()))
+    return jsonify(payload)
+
+def _analytics_payload():
+    # pandas is only imported once analytics are asked for, startup stays light
+    from backend import analytics
+
+    time = request.args.get('time', '')
+    year, month, day, total = _parse_time_from_arg(time, default_total_if_empty=True)
+    start, end = utils.get_date_range(year, month, day, total)
+    if request.args.get('search_id', '').strip():
+        start = end = None
+    where_clause, params, duration = _build_where_and_params_from_request(
+        default_total_if_empty=True, lookback_days=analytics.LOOKBACK_DAYS)
+
+    payload = analytics.compute(analytics.load_ledger(where_clause, params), start, end)
+    payload['duration'] = duration
+    return payload
+
+# ---- metrics ----
+@route('/metrics')
+def metrics_view():
+    for cache in (dashboard_cache, analytics_cache):
+        stats = cache.stats()
+        metrics.gauge('result_cache_entries', stats['size'], help='results currently cached', cache=cache.name)
+        metrics.gauge('result_cache_max_entries', stats['maxsize'], help='result cache capacity', cache=cache.name)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # ---- sync ----
-@app.route('/sync_data', methods=['POST'])
+@route('/sync_data', methods=['POST'])
 def sync_data():
     script = os.environ.get('SYNC_UPLOAD_SCRIPT')
     if not script:
         return jsonify({'ok': False, 'error': 'SYNC_UPLOAD_SCRIPT not set'}), 500
 
     try:
+        # queued (or merged into an upload that is already waiting), the worker checkpoints the WAL first
         job = sync_mod.start_sync_job(script)
     except FileNotFoundError as e:
         return jsonify({'ok': False, 'error': str(e)}), 500
@@ -745,22 +1203,56 @@ def sync_data():
         return jsonify({'ok': False, 'error': str(e)}), 500
 
     # return job id & pid
-    return jsonify({'ok': True, 'job_id': job['job_id'], 'pid': job['pid'], 'log_url': url_for('sync_log', job_id=job['job_id'])}), 200
+    return jsonify({'ok': True, 'job_id': job['job_id'], 'pid': job['pid'], 'state': job['state'], 'merged': job['merged'],
+                    'log_url': url_for('sync_log', job_id=job['job_id'])}), 200
 
 
-@app.route('/sync_status/<job_id>')
+@route('/sync_status/<job_id>')
 def sync_status(job_id):
     job = sync_mod.get_job(job_id)
     if not job:
         return jsonify({'ok': False, 'error': 'job not found'}), 404
-    return jsonify({'ok': True, 'running': job['running'], 'pid': job['pid'], 'started_at': job['started_at'], 'returncode': job['returncode'], 'error': job.get('error')})
+    return jsonify({'ok': True, 'running': job['running'], 'state': job['state'], 'pid': job['pid'], 'created_at': job['created_at'],
+                    'started_at': job['started_at'], 'finished_at': job['finished_at'], 'returncode': job['returncode'],
+                    'merged': job['merged'], 'error': job.get('error')})
 
-@app.route('/sync_log/<job_id>')
+@route('/sync_log/<job_id>')
 def sync_log(job_id):
-    res = sync_mod.tail_log(job_id)
+    # ?offset=N returns only the log bytes after N (and the next offset), without it the tail
+    offset = request.args.get('offset', type=int)
+    res = sync_mod.read_log(job_id, None if offset is None else max(0, offset))
     if res is None:
         return jsonify({'ok': False, 'error': 'job not found'}), 404
     return jsonify(res)
 
+def _sse(event, data, event_id=None):
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {event}\ndata: {json.dumps(data)}\n\n'
+
+@route('/sync_log/<job_id>/stream')
+def sync_log_stream(job_id):
+    """
+    server-sent events: 'log' events with new output as it is written, then one 'done'
+    event with the return code. the event id is the byte offset, so a reconnecting
+    EventSource (Last-Event-ID) continues where it stopped
+    """
+    if sync_mod.get_job(job_id) is None:
+        return jsonify({'ok': False, 'error': 'job not found'}), 404
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None:
+        offset = request.args.get('offset', 0, type=int)
+
+    def events():
+        yield 'retry: 2000\n\n'
+        for kind, payload, next_offset in sync_mod.follow_log(job_id, max(0, offset)):
+            if kind == 'log':
+                yield _sse('log', {'text': payload}, next_offset)
+            else:
+                job = payload or {}
+                yield _sse('done', {'state': job.get('state'), 'returncode': job.get('returncode'), 'error': job.get('error')}, next_offset)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == '__main__':
-    app.run(debug=False)
\ No newline at end of file
+    create_app().run(debug=False)
\ No newline at end of file
@@ -1,6 +1,7 @@
 from backend import db as dbmod
 from backend.utils import autocategory, parse_date
 from backend import rates
+from backend.categories import category_id_for
 
 
 def execute_addition(cursor, date_str, description, amount, category, is_expense):
@@ -12,9 +13,9 @@ def execute_addition(cursor, date_str, description, amount, category, is_expense
         category = autocategory(description)
 
     cursor.execute('''
-        INSERT INTO expenses (date, description, amount, category, is_expense)
+        INSERT INTO expenses (date, description, amount_cents, category_id, is_expense)
         VALUES (?, ?, ?, ?, ?)
-    ''', (date_str, description, amount, category, int(is_expense)))
+    ''', (date_str, description, dbmod.to_cents(amount), category_id_for(category), int(is_expense)))
 
 
 def create_transaction(date_str, description, amount, category='', is_expense=1, currency=None):
@@ -0,0 +1,169 @@
+from backend import db as dbmod
+from backend import categories as catmod
+
+# -------------------------
+# database
+# -------------------------
+# per (day|month, category_id, is_expense) sums of expenses.amount_cents, kept up to date
+# by triggers so every write path (add, edit, delete, automations, deleted
+# categories, raw sql) is covered. uncategorized rows are stored as category_id 0,
+# names are joined in when reading so renames don't touch these tables
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_totals (
+    day TEXT NOT NULL,
+    category_id INTEGER NOT NULL,
+    is_expense INTEGER NOT NULL,
+    total_cents INTEGER NOT NULL DEFAULT 0,
+    n INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, category_id, is_expense)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS monthly_totals (
+    month TEXT NOT NULL,
+    category_id INTEGER NOT NULL,
+    is_expense INTEGER NOT NULL,
+    total_cents INTEGER NOT NULL DEFAULT 0,
+    n INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (month, category_id, is_expense)
+) WITHOUT ROWID;
+"""
+
+_ADD_ROW = """
+    INSERT INTO daily_totals (day, category_id, is_expense, total_cents, n)
+    VALUES (IFNULL(substr({r}.date, 1, 10), ''), IFNULL({r}.category_id, 0), IFNULL({r}.is_expense, 0), IFNULL({r}.amount_cents, 0), 1)
+    ON CONFLICT (day, category_id, is_expense) DO UPDATE SET total_cents = total_cents + excluded.total_cents, n = n + 1;
+    INSERT INTO monthly_totals (month, category_id, is_expense, total_cents, n)
+    VALUES (IFNULL(substr({r}.date, 1, 7), ''), IFNULL({r}.category_id, 0), IFNULL({r}.is_expense, 0), IFNULL({r}.amount_cents, 0), 1)
+    ON CONFLICT (month, category_id, is_expense) DO UPDATE SET total_cents = total_cents + excluded.total_cents, n = n + 1;
+"""
+
+_REMOVE_ROW = """
+    UPDATE daily_totals SET total_cents = total_cents - IFNULL({r}.amount_cents, 0), n = n - 1
+    WHERE day = IFNULL(substr({r}.date, 1, 10), '') AND category_id = IFNULL({r}.category_id, 0) AND is_expense = IFNULL({r}.is_expense, 0);
+    DELETE FROM daily_totals
+    WHERE day = IFNULL(substr({r}.date, 1, 10), '') AND category_id = IFNULL({r}.category_id, 0) AND is_expense = IFNULL({r}.is_expense, 0) AND n <= 0;
+    UPDATE monthly_totals SET total_cents = total_cents - IFNULL({r}.amount_cents, 0), n = n - 1
+    WHERE month = IFNULL(substr({r}.date, 1, 7), '') AND category_id = IFNULL({r}.category_id, 0) AND is_expense = IFNULL({r}.is_expense, 0);
+    DELETE FROM monthly_totals
+    WHERE month = IFNULL(substr({r}.date, 1, 7), '') AND category_id = IFNULL({r}.category_id, 0) AND is_expense = IFNULL({r}.is_expense, 0) AND n <= 0;
+"""
+
+TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS trg_expenses_agg_insert AFTER INSERT ON expenses
+BEGIN
+    {_ADD_ROW.format(r='NEW')}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_expenses_agg_delete AFTER DELETE ON expenses
+BEGIN
+    {_REMOVE_ROW.format(r='OLD')}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_expenses_agg_update AFTER UPDATE OF date, amount_cents, category_id, is_expense ON expenses
+BEGIN
+    {_REMOVE_ROW.format(r='OLD')}
+    {_ADD_ROW.format(r='NEW')}
+END;
+"""
+
+def init_aggregates_db():
+    """create summary tables + triggers, fill them if they are still empty"""
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        old = dbmod.table_columns(cur, 'daily_totals') & {'category', 'total'}
+        if old:
+            # keyed by category name before categories became ids, or REAL totals
+            # before amounts became cents: start over
+            cur.executescript("""
+                DROP TRIGGER IF EXISTS trg_expenses_agg_insert;
+                DROP TRIGGER IF EXISTS trg_expenses_agg_delete;
+                DROP TRIGGER IF EXISTS trg_expenses_agg_update;
+                DROP TABLE IF EXISTS daily_totals;
+                DROP TABLE IF EXISTS monthly_totals;
+            """)
+        cur.executescript(SCHEMA + TRIGGERS)
+        cur.execute('SELECT EXISTS(SELECT 1 FROM daily_totals) AS has_totals, EXISTS(SELECT 1 FROM expenses) AS has_rows')
+        row = cur.fetchone()
+        conn.commit()
+    if row['has_rows'] and not row['has_totals']:
+        rebuild_aggregates()
+
+def rebuild_aggregates():
+    """recompute both summary tables from expenses"""
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM daily_totals')
+        cur.execute('DELETE FROM monthly_totals')
+        cur.execute("""
+            INSERT INTO daily_totals (day, category_id, is_expense, total_cents, n)
+            SELECT IFNULL(substr(date, 1, 10), ''), IFNULL(category_id, 0), IFNULL(is_expense, 0), SUM(IFNULL(amount_cents, 0)), COUNT(*)
+            FROM expenses
+            GROUP BY 1, 2, 3
+        """)
+        cur.execute("""
+            INSERT INTO monthly_totals (month, category_id, is_expense, total_cents, n)
+            SELECT substr(day, 1, 7), category_id, is_expense, SUM(total_cents), SUM(n)
+            FROM daily_totals
+            GROUP BY 1, 2, 3
+        """)
+        conn.commit()
+        cur.execute('SELECT COUNT(*) FROM daily_totals')
+        return cur.fetchone()[0]
+
+# -------------------------
+# queries
+# -------------------------
+def _range(column, start, end, width):
+    """WHERE fragment for a [start, end) 'YYYY-MM-DD' range on a day (10) or month (7) key"""
+    if start is None:
+        return '', []
+    return f' AND {column} >= ? AND {column} < ?', [start[:width], end[:width]]
+
+def daily_expense_totals(start, end):
+    """[(day, total)] of expenses per day, total is positive"""
+    cond, params = _range('day', start, end, 10)
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT day, -SUM(total_cents) / 100.0 AS total
+            FROM daily_totals
+            WHERE is_expense = 1 {cond}
+            GROUP BY day
+            ORDER BY day
+        """, params)
+        return cur.fetchall()
+
+def monthly_expense_totals(start, end):
+    """[(ym, total)] of expenses per month, total is positive"""
+    cond, params = _range('month', start, end, 7)
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT month AS ym, -SUM(total_cents) / 100.0 AS total
+            FROM monthly_totals
+            WHERE is_expense = 1 {cond}
+            GROUP BY month
+            ORDER BY month
+        """, params)
+        return cur.fetchall()
+
+def category_expense_totals(start, end, limit=50):
+    """
+    [{'category', 'total'}] of expenses, biggest first. grouped by id, names come from the category snapshot.
+    ranges made of whole months read the monthly table, anything else the daily one
+    """
+    whole_months = start is None or (start.endswith('-01') and end.endswith('-01'))
+    if whole_months:
+        table, cond, params = 'monthly_totals', *_range('month', start, end, 7)
+    else:
+        table, cond, params = 'daily_totals', *_range('day', start, end, 10)
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT category_id, -SUM(total_cents) / 100.0 AS total
+            FROM {table}
+            WHERE is_expense = 1 {cond}
+            GROUP BY category_id
+            ORDER BY total DESC
+            LIMIT ?
+        """, params + [limit])
+        rows = cur.fetchall()
+    names = catmod.category_names()
+    return [{'category': names.get(r['category_id'], '(none)'), 'total': r['total']} for r in rows]
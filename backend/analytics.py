@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+from backend import db as dbmod
+from backend import categories as catmod
+
+# spend statistics computed with pandas / numpy on the filtered ledger.
+# the rows are read once into columns, everything else is vectorized.
+# amounts are returned as positive spend, like the dashboard does
+WINDOWS = (30, 90)
+PERCENTILES = (50, 75, 90, 95, 99)
+MOM_LIMIT = 50
+# rows loaded before the requested range: the longest window minus one day,
+# which also covers the month before a month or day view
+LOOKBACK_DAYS = max(WINDOWS) - 1
+
+def load_ledger(where_clause='WHERE 1=1', params=()):
+    """expenses matching the filter as a DataFrame with day (datetime64), spend (float) and category_id (int, 0 = none)"""
+    q = f'SELECT date, amount_cents, category_id FROM expenses {where_clause} AND is_expense = 1'
+    with dbmod.get_conn() as conn:
+        df = pd.read_sql_query(q, conn, params=list(params))
+    return pd.DataFrame({
+        'day': pd.to_datetime(df['date'].str.slice(0, 10), errors='coerce'),
+        'spend': -pd.to_numeric(df['amount_cents']).fillna(0).to_numpy(dtype='float64') / 100,
+        'category_id': pd.to_numeric(df['category_id']).fillna(0).astype('int64'),
+    }).dropna(subset=['day'])
+
+def _empty(start, end):
+    return {
+        'start': start, 'end': end, 'days': 0, 'count': 0, 'total': 0.0, 'daily_burn': 0.0,
+        'percentiles': {f'p{p}': 0.0 for p in PERCENTILES},
+        'rolling': {'labels': [], **{f'spend_{w}d': [] for w in WINDOWS}},
+        'mom': {'month': None, 'previous_month': None, 'categories': []},
+        'empty': True,
+    }
+
+def compute(df, start=None, end=None, today=None):
+    """
+    statistics for [start, end) ('YYYY-MM-DD', None = the data's own range).
+    df may contain rows before start: they only feed the rolling windows and the
+    month-over-month comparison, so those are complete from the first day on
+    """
+    today = pd.Timestamp(today or pd.Timestamp.today().normalize())
+    if df.empty:
+        return _empty(start, end)
+    first = pd.Timestamp(start) if start else df['day'].min()
+    stop = pd.Timestamp(end) if end else df['day'].max() + pd.Timedelta(days=1)
+
+    # daily totals on a continuous calendar, days without spend are 0
+    calendar_days = pd.date_range(min(df['day'].min(), first), stop - pd.Timedelta(days=1), freq='D')
+    daily = df.groupby('day')['spend'].sum().reindex(calendar_days, fill_value=0.0)
+    in_range = (daily.index >= first) & (daily.index < stop)
+
+    rolling = {'labels': [d.strftime('%Y-%m-%d') for d in daily.index[in_range]]}
+    for w in WINDOWS:
+        rolling[f'spend_{w}d'] = np.round(daily.rolling(w, min_periods=1).sum().to_numpy()[in_range], 2).tolist()
+
+    rows = df[(df['day'] >= first) & (df['day'] < stop)]
+    spend = rows['spend'].to_numpy()
+    if spend.size:
+        pct = np.percentile(spend, PERCENTILES)
+    else:
+        pct = np.zeros(len(PERCENTILES))
+    # burn rate over the days that have passed, a running month isn't divided by 31
+    elapsed = max(1, (min(stop, today + pd.Timedelta(days=1)) - first).days)
+
+    return {
+        'start': first.strftime('%Y-%m-%d'),
+        'end': stop.strftime('%Y-%m-%d'),
+        'days': elapsed,
+        'count': int(spend.size),
+        'total': round(float(spend.sum()), 2),
+        'daily_burn': round(float(spend.sum()) / elapsed, 2),
+        'percentiles': {f'p{p}': round(float(v), 2) for p, v in zip(PERCENTILES, pct)},
+        'rolling': rolling,
+        'mom': _month_over_month(df, first + pd.Timedelta(days=elapsed)),
+        'empty': spend.size == 0,
+    }
+
+def _month_over_month(df, stop):
+    """per category: spend of the month before stop (so up to today) vs the month before that"""
+    months = df['day'].dt.to_period('M')
+    last = (stop - pd.Timedelta(days=1)).to_period('M')
+    previous = last - 1
+
+    window = (months == last) | (months == previous)
+    table = (df[window].assign(month=months[window])
+             .pivot_table(index='category_id', columns='month', values='spend', aggfunc='sum', fill_value=0.0)
+             .reindex(columns=[previous, last], fill_value=0.0))
+    current = table[last].to_numpy()
+    before = table[previous].to_numpy()
+    delta = current - before
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.where(before > 0, delta / before * 100, np.nan)
+
+    order = np.argsort(-np.abs(delta), kind='stable')[:MOM_LIMIT]
+    names = catmod.category_names()
+    ids = table.index.to_numpy()
+    return {
+        'month': str(last),
+        'previous_month': str(previous),
+        'categories': [{
+            'category': names.get(int(ids[i]), '(none)'),
+            'current': round(float(current[i]), 2),
+            'previous': round(float(before[i]), 2),
+            'delta': round(float(delta[i]), 2),
+            'pct': None if np.isnan(pct[i]) else round(float(pct[i]), 1),
+        } for i in order],
+    }
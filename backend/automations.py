@@ -1,9 +1,8 @@
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+from datetime import datetime, timedelta
 
 from backend import db as dbmod
-from backend.add_transcations import execute_addition
 from backend.utils import autocategory, safe_date
+from backend.categories import category_id_for
 
 # -------------------------
 # database
@@ -19,17 +18,30 @@ def init_automations_db():
             day INTEGER NOT NULL,
             description TEXT NOT NULL,
             amount REAL NOT NULL,
-            category TEXT,
+            category_id INTEGER REFERENCES categories(id) ON DELETE SET NULL,
             is_expense INTEGER NOT NULL DEFAULT 1,
             start DATE,
-            end DATE
+            end DATE,
+            generated_until DATE
         );
         """)
+        # generated_until: last day already covered by update_fix_transactions
+        dbmod.add_missing_columns(cur, [
+            ('automations', 'generated_until', 'DATE'),
+            ('automations', 'category_id', 'INTEGER REFERENCES categories(id) ON DELETE SET NULL'),
+        ])
+        dbmod.migrate_category_names(cur, 'automations')
         conn.commit()
 
 # -------------------------
 # CRUD helpers
 # -------------------------
+# automations with their category name (the table only stores category_id)
+AUTOMATION_SELECT = (
+    "SELECT a.id, a.day, a.description, a.amount, a.category_id, COALESCE(c.name, '') AS category, "
+    "a.is_expense, a.start, a.end FROM automations a LEFT JOIN categories c ON c.id = a.category_id"
+)
+
 def check_for_end_day(end_date_str):
     end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
     current_date = datetime.now()
@@ -41,7 +53,7 @@ def list_automations():
     """return list of dicts"""
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
-        cur.execute('SELECT id, day, description, amount, category, is_expense, start, end FROM automations ORDER BY id')
+        cur.execute(AUTOMATION_SELECT + ' ORDER BY a.id')
         rows = cur.fetchall()
 
     out = []
@@ -61,7 +73,7 @@ def list_automations():
 def get_automation_by_id(aid):
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
-        cur.execute('SELECT id, day, description, amount, category, is_expense, start, end FROM automations WHERE id = ?', (aid,))
+        cur.execute(AUTOMATION_SELECT + ' WHERE a.id = ?', (aid,))
         r = cur.fetchone()
     return dict(r) if r else None
 
@@ -109,9 +121,9 @@ def add_automation(day, description, amount, category, is_expense, start, end):
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
         cur.execute("""
-            INSERT INTO automations (day, description, amount, category, is_expense, start, end)
+            INSERT INTO automations (day, description, amount, category_id, is_expense, start, end)
             VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (day_i, description, amount_f, category or '', is_exp, start_str, end_checked_str))
+        """, (day_i, description, amount_f, category_id_for(category), is_exp, start_str, end_checked_str))
         conn.commit()
         return cur.lastrowid
 
@@ -148,13 +160,18 @@ def update_automation(aid, new_data):
         except Exception:
             raise ValueError('end must be YYYY-MM-DD')
 
+    # a new start date can reach back before the watermark, so cover the whole range again
+    # (the unique automation key keeps already generated months from being duplicated)
+    reset_watermark = (start_val or '') != str(existing['start'] or '')
+
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
         cur.execute("""
            UPDATE automations
-           SET day=?, description=?, amount=?, category=?, is_expense=?, start=?, end=?
+           SET day=?, description=?, amount=?, category_id=?, is_expense=?, start=?, end=?,
+               generated_until = CASE WHEN ? THEN NULL ELSE generated_until END
            WHERE id=?
-        """, (day, description, amount, category or '', is_expense, start_val, end_val, aid))
+        """, (day, description, amount, category_id_for(category), is_expense, start_val, end_val, int(reset_watermark), aid))
         conn.commit()
         return cur.rowcount > 0
 
@@ -165,50 +182,74 @@ def delete_automation(aid):
         conn.commit()
         return cur.rowcount > 0
 
+def _occurrences(day_i, start_date, end_date, after=None):
+    """
+    monthly dates on day_i (clamped to the month's last day) from start_date to end_date,
+    only those later than `after` (the watermark) if given
+    """
+    lower = start_date
+    if after is not None and after >= lower:
+        lower = after + timedelta(days=1)
+
+    year, month = lower.year, lower.month
+    dates = []
+    while datetime(year, month, 1) <= end_date:
+        candidate = safe_date(year, month, day_i)
+        if lower <= candidate <= end_date:
+            dates.append(candidate)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return dates
+
+def _adopt_legacy_rows(cur, aid, dates, category_id, description):
+    """
+    rows generated before automations were tracked have no automation_id.
+    link them to the automation, so the unique key sees them as already generated.
+    they also get the uid a generated row has (see changelog), so the row is the same on every device
+    """
+    date_strs = [d.strftime('%Y-%m-%d') for d in dates]
+    for i in range(0, len(date_strs), 500):
+        chunk = date_strs[i:i + 500]
+        marks = ','.join('?' * len(chunk))
+        cur.execute(f"""
+            UPDATE OR IGNORE expenses SET automation_id = ?, occurrence = date,
+                uid = COALESCE((SELECT uid FROM automations WHERE id = ?) || '/' || date, uid)
+            WHERE automation_id IS NULL AND category_id IS ? AND description = ? AND date IN ({marks})
+        """, [aid, aid, category_id, description] + chunk)
+
 def update_fix_transactions():
     """
-    read automations from DB and add missing monthly entries into expenses
+    read automations from DB and add missing monthly entries into expenses.
+    each automation only covers the months after its generated_until watermark,
+    so a run costs the same no matter how long ago the automation started
     """
-    # read automations first
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
-        cur.execute('SELECT day, description, amount, category, is_expense, start, end FROM automations')
+        cur.execute('SELECT id, day, description, amount, category_id, is_expense, start, end, generated_until FROM automations')
         rows = cur.fetchall()
 
-    if not rows:
-        return
+        if not rows:
+            return
 
-    # use same DB for expense insertion (commit once at the end)
-    with dbmod.get_conn() as conn_exp:
-        cexp = conn_exp.cursor()
         for r in rows:
-            day_str = str(r['day'])
             # validate day is integer in sensible range
             try:
-                day_i = int(day_str)
+                day_i = int(str(r['day']))
                 if not (1 <= day_i <= 31):
                     # invalid day-of-month, skip
                     continue
             except Exception:
                 continue
 
-            
-            description = r['description']
-            amount = r['amount']
-            category = r['category']
-            is_expense = r['is_expense']
-            start = r['start']
-            end = r['end']
-
             # parse start date
             try:
-                start_date = datetime.strptime(str(start), '%Y-%m-%d')
+                start_date = datetime.strptime(str(r['start']), '%Y-%m-%d')
             except Exception:
                 # invalid start format -> skip this automation
                 # happends
                 continue
 
-             # parse end date if provided, otherwise default to today
+            # parse end date if provided, otherwise default to today
+            end = r['end']
             if end and str(end).strip() != '':
                 try:
                     end_date = datetime.strptime(str(end), '%Y-%m-%d')
@@ -223,44 +264,29 @@ def update_fix_transactions():
                 # skip invalid automation
                 continue
 
-            # find first candidate date >= start_date
-            year = start_date.year
-            month = start_date.month
-            first_candidate = None
-
-            while True:
-                if datetime(year, month, 1) > end_date:
-                    break
-
-                candidate = safe_date(year, month, day_i)
-
-                if candidate >= start_date:
-                    first_candidate = candidate
-                    break
-                else:
-                    next_month = (datetime(year, month, 1) + relativedelta(months=1))
-                    year, month = next_month.year, next_month.month
-
-            if first_candidate is None:
-                continue
+            watermark = None
+            if r['generated_until']:
+                try:
+                    watermark = datetime.strptime(str(r['generated_until']), '%Y-%m-%d')
+                except Exception:
+                    watermark = None
 
-            # iterate month-by-month from first_candidate to end_date
-            current_date = first_candidate
-            while current_date <= end_date:
-                current_date_str = current_date.strftime('%Y-%m-%d')
+            dates = _occurrences(day_i, start_date, end_date, watermark)
+            if dates:
+                description = r['description']
+                category_id = r['category_id'] or category_id_for(autocategory(description))
+                if watermark is None:
+                    _adopt_legacy_rows(cur, r['id'], dates, category_id, description)
 
-                # avoid duplicates: same date + same category + same description
-                cexp.execute(
-                    'SELECT 1 FROM expenses WHERE date = ? AND category = ? AND description = ?',
-                    (current_date_str, category, description)
-                )
-                existing_entry = cexp.fetchone()
-                if not existing_entry:
-                    execute_addition(cexp, current_date_str, description, float(amount), category, int(is_expense))
+                cur.executemany("""
+                    INSERT OR IGNORE INTO expenses (date, description, amount_cents, category_id, is_expense, automation_id, occurrence)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [(d.strftime('%Y-%m-%d'), description, dbmod.to_cents(r['amount']), category_id, int(r['is_expense']),
+                       r['id'], d.strftime('%Y-%m-%d')) for d in dates])
 
-                # move to next month using safe_date
-                next_month = (current_date.replace(day=1) + relativedelta(months=1))
-                current_date = safe_date(next_month.year, next_month.month, day_i)
+            covered = end_date.strftime('%Y-%m-%d')
+            if covered != str(r['generated_until'] or ''):
+                cur.execute('UPDATE automations SET generated_until = ? WHERE id = ?', (covered, r['id']))
 
         # commit all inserted transactions
-        conn_exp.commit()
\ No newline at end of file
+        conn.commit()
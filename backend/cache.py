@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+
+from backend import metrics
+
+class ResultCache:
+    """
+    bounded LRU of computed results with request coalescing.
+
+    entries belong to a data version (e.g. the db write sequence): when a lookup
+    comes with a newer version, everything cached so far is dropped. concurrent
+    misses for the same key wait for the first one instead of computing again
+    """
+
+    def __init__(self, name, maxsize=128):
+        self.name = name
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> value
+        self._inflight = {}            # key -> (event, result holder)
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.coalesced = 0
+
+    def _count(self, result):
+        setattr(self, result, getattr(self, result) + 1)
+        metrics.inc('result_cache_total', help='result cache lookups', cache=self.name, result=result)
+
+    def invalidate(self):
+        """drop all entries, e.g. after the database file was replaced"""
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def get_or_compute(self, key, compute, version=None):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._count('hits')
+                return self._entries[key]
+            waiting = self._inflight.get((version, key))
+            leader = waiting is None
+            if leader:
+                waiting = self._inflight[(version, key)] = (threading.Event(), {})
+            self._count('misses' if leader else 'coalesced')
+
+        event, holder = waiting
+        if not leader:
+            event.wait()
+            if 'error' in holder:
+                raise holder['error']
+            return holder['value']
+
+        try:
+            value = compute()
+            holder['value'] = value
+        except Exception as e:
+            holder['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop((version, key), None)
+                if 'value' in holder and version == self._version:
+                    self._entries[key] = holder['value']
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+            event.set()
+        return value
+
+    def stats(self):
+        """current size and lookup counts, the size is exported as a gauge at /metrics"""
+        with self._lock:
+            size = len(self._entries)
+        return {'size': size, 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
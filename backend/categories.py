@@ -1,9 +1,45 @@
 from typing import Dict, List
 from backend import db as dbmod
 
+# bumped by invalidate_categories(), e.g. when the db file was replaced: the counter
+# below starts over in the new file
+_epoch = 0
+
+# (version, categories list) of the last load, shared by every reader in this process
+_snapshot = None
+
+def categories_version():
+    """
+    (version, shareable). the version changes with every committed write to categories or
+    keywords, in any process (cli import, other workers, sync apply): it is read from
+    categories_seq. inside this thread's open transaction the view may include uncommitted
+    changes, shareable is False then and derived caches must not store what they build
+    """
+    with dbmod.get_conn() as conn:
+        row = conn.execute('SELECT seq FROM categories_seq WHERE id = 1').fetchone()
+        shareable = not conn.in_transaction
+    return (_epoch, row['seq'] if row else 0), shareable
+
+def invalidate_categories():
+    """drop cached categories, e.g. after the database file was replaced by a sync download"""
+    global _epoch
+    _epoch += 1
+
 # -------------------------
 # database
 # -------------------------
+# one counter bumped by every change to categories or keywords, like write_seq.
+# the triggers bump it in the writing transaction, so other connections see the
+# new value together with the change, once it is committed
+VERSION_SEQ = [
+    'CREATE TABLE IF NOT EXISTS categories_seq (id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL)',
+    'INSERT OR IGNORE INTO categories_seq (id, seq) VALUES (1, 0)',
+] + [
+    f'CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{op.lower()} AFTER {op} ON {table} '
+    f'BEGIN UPDATE categories_seq SET seq = seq + 1 WHERE id = 1; END'
+    for table in ('categories', 'category_keywords') for op in ('INSERT', 'UPDATE', 'DELETE')
+]
+
 def init_categories_db():
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
@@ -20,42 +56,61 @@ def init_categories_db():
           FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE CASCADE
         );
         """)
+        for sql in VERSION_SEQ:
+            cur.execute(sql)
         conn.commit()
 
 # -------------------------
 # CRUD helpers
 # -------------------------
-def get_categories_dict() -> Dict[str, List[str]]:
-    """return a dict: {category_name: [keyword, ...], ...}"""
+def _load_categories():
+    """all categories with their keywords, in one query"""
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
         cur.execute("""
-            SELECT c.id, c.name, k.keyword
+            SELECT c.id, c.name, c.emoji, k.id AS keyword_id, k.keyword
             FROM categories c
             LEFT JOIN category_keywords k ON k.category_id = c.id
             ORDER BY c.name, k.keyword
         """)
         rows = cur.fetchall()
 
-    cats = {}
+    cats = []
     for r in rows:
-        name = r['name']
-        cats.setdefault(name, [])
-        if r['keyword'] is not None:
-            cats[name].append(r['keyword'])
+        if not cats or cats[-1]['id'] != r['id']:
+            cats.append({'id': r['id'], 'name': r['name'], 'emoji': r['emoji'], 'keywords': []})
+        if r['keyword_id'] is not None:
+            cats[-1]['keywords'].append({'id': r['keyword_id'], 'keyword': r['keyword']})
     return cats
 
 def list_categories_with_ids():
-    with dbmod.get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute('SELECT id, name, emoji FROM categories ORDER BY name')
-        cats = []
-        for c in cur.fetchall():
-            cur.execute('SELECT id, keyword FROM category_keywords WHERE category_id = ? ORDER BY keyword', (c['id'],))
-            keywords = [{'id': k['id'], 'keyword': k['keyword']} for k in cur.fetchall()]
-            cats.append({'id': c['id'], 'name': c['name'], 'emoji': c['emoji'], 'keywords': keywords})
+    """
+    [{'id', 'name', 'emoji', 'keywords': [{'id', 'keyword'}]}] sorted by name.
+    served from a snapshot that is reloaded only after a mutation, treat it as read-only
+    """
+    global _snapshot
+    version, shareable = categories_version()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot[0] == version:
+        return snapshot[1]
+    # a change committed while loading leaves the older version on the snapshot, so it is reloaded next time
+    cats = _load_categories()
+    if shareable:
+        _snapshot = (version, cats)
     return cats
 
+def get_categories_dict() -> Dict[str, List[str]]:
+    """return a dict: {category_name: [keyword, ...], ...}"""
+    return {c['name']: [k['keyword'] for k in c['keywords']] for c in list_categories_with_ids()}
+
+def category_emoji_map() -> Dict[str, str]:
+    """lowercase category name -> emoji ('' if none)"""
+    return {c['name'].lower(): c['emoji'] or '' for c in list_categories_with_ids() if c['name'] is not None}
+
+def category_names() -> Dict[int, str]:
+    """category id -> name"""
+    return {c['id']: c['name'] for c in list_categories_with_ids()}
+
 def add_category(name: str, emoji: str = None):
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
@@ -66,26 +121,15 @@ def add_category(name: str, emoji: str = None):
         return row['id'] if row else None
 
 def update_category_name(cat_id: int, new_name: str, new_emoji: str = None):
+    # transactions reference the id, so a rename is a single row update
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
-        # get old name first
-        cur.execute('SELECT name FROM categories WHERE id = ?', (cat_id,))
-        row = cur.fetchone()
-        if not row:
-            return False
-        old_name = row[0]
-
-        # update categories table (name + optional emoji)
         if new_emoji is None:
             cur.execute('UPDATE categories SET name = ? WHERE id = ?', (new_name, cat_id))
         else:
             cur.execute('UPDATE categories SET name = ?, emoji = ? WHERE id = ?', (new_name, new_emoji, cat_id))
-        updated = cur.rowcount > 0
-
-        # update all existing transactions for the name change
-        cur.execute('UPDATE expenses SET category = ? WHERE category = ?', (new_name, old_name))
         conn.commit()
-        return updated
+        return cur.rowcount > 0
 
 def delete_category(cat_id: int):
     with dbmod.get_conn() as conn:
@@ -108,6 +152,26 @@ def delete_keyword(keyword_id: int):
         conn.commit()
         return cur.rowcount > 0
 
+def category_id_for(name: str, create: bool = True):
+    """
+    id of the category called `name`, the category is created if it doesn't exist yet.
+    None for an empty name (uncategorized). runs inside the caller's transaction if there is one
+    """
+    name = (name or '').strip()
+    if name == '':
+        return None
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT id FROM categories WHERE name = ?', (name,))
+        row = cur.fetchone()
+        if row or not create:
+            return row['id'] if row else None
+        outer = conn.in_transaction
+        cur.execute('INSERT INTO categories (name) VALUES (?)', (name,))
+        if not outer:
+            conn.commit()
+        return cur.lastrowid
+
 def find_category_by_name(name: str):
     with dbmod.get_conn() as conn:
         cur = conn.cursor()
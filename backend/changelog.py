@@ -0,0 +1,280 @@
+import gzip
+import json
+import sqlite3
+import time
+
+from backend import db as dbmod
+
+# -------------------------
+# database
+# -------------------------
+# every row of the synced tables gets a uid, the same on all devices (the local
+# integer ids differ). triggers write one change_log entry per changed row with
+# a new seq (AUTOINCREMENT: only grows, never reused), the op and the row's
+# version: when and on which device it was changed. a row's next change replaces
+# its entry, so the log holds one entry per row (deletes stay as tombstones) and
+# "everything after seq N" is exactly the rows that changed since then.
+
+# per table: columns exchanged as they are, and (column, referenced table) pairs
+# exchanged as the referenced row's uid. in dependency order: upserts are applied
+# in this order, deletes in reverse
+TABLES = {
+    'categories': (['name', 'emoji'], []),
+    'category_keywords': (['keyword'], [('category_id', 'categories')]),
+    # generated_until is local bookkeeping of the automation run, not synced
+    'automations': (['day', 'description', 'amount', 'is_expense', 'start', 'end'], [('category_id', 'categories')]),
+    'expenses': (['date', 'description', 'amount_cents', 'is_expense', 'occurrence'],
+                 [('category_id', 'categories'), ('automation_id', 'automations')]),
+}
+
+_RANDOM_UID = 'lower(hex(randomblob(16)))'
+
+# uid of a new row ({r} = NEW in the triggers, the table itself when backfilling).
+# a category is named after its name, so the same category created on two devices
+# is one row after a sync. a generated expense is named after its automation and
+# occurrence, so both devices generate the same row. otherwise random
+_NEW_UID = {
+    'categories': f"""CASE WHEN NOT EXISTS (SELECT 1 FROM categories x WHERE x.uid = 'name:' || {{r}}.name)
+        THEN 'name:' || {{r}}.name ELSE {_RANDOM_UID} END""",
+    'expenses': f"""COALESCE((SELECT a.uid || '/' || {{r}}.occurrence FROM automations a
+        WHERE a.id = {{r}}.automation_id AND {{r}}.occurrence IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM expenses x WHERE x.uid = a.uid || '/' || {{r}}.occurrence)), {_RANDOM_UID})""",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_device (id INTEGER PRIMARY KEY CHECK (id = 1), device_id TEXT NOT NULL);
+INSERT OR IGNORE INTO sync_device (id, device_id) VALUES (1, lower(hex(randomblob(8))));
+CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tbl TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    op TEXT NOT NULL,
+    changed_at TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    UNIQUE (tbl, uid)
+);
+CREATE TABLE IF NOT EXISTS sync_peers (
+    device_id TEXT PRIMARY KEY,
+    received_seq INTEGER NOT NULL DEFAULT 0,
+    sent_seq INTEGER NOT NULL DEFAULT 0,
+    last_sync TEXT
+);
+"""
+# received_seq: the peer's log is applied here up to this seq.
+# sent_seq: the peer confirmed it applied this log up to this seq
+
+_LOG = """
+    DELETE FROM change_log WHERE tbl = '{table}' AND uid = {uid};
+    INSERT INTO change_log (tbl, uid, op, changed_at, origin)
+    VALUES ('{table}', {uid}, '{op}', strftime('%Y-%m-%d %H:%M:%f', 'now'), (SELECT device_id FROM sync_device WHERE id = 1));
+"""
+
+def _triggers(table):
+    columns, refs = TABLES[table]
+    watched = ', '.join(['uid'] + columns + [c for c, _ in refs])
+    new_uid = _NEW_UID.get(table, _RANDOM_UID).format(r='NEW')
+    # the uid is assigned by an update inside the insert trigger, OLD.uid IS NULL
+    # keeps that update out of the log. a changed uid is a delete of the old one
+    return f"""
+CREATE TRIGGER IF NOT EXISTS trg_{table}_log_insert AFTER INSERT ON {table}
+BEGIN
+    UPDATE {table} SET uid = {new_uid} WHERE id = NEW.id AND uid IS NULL;
+    {_LOG.format(table=table, uid=f'(SELECT uid FROM {table} WHERE id = NEW.id)', op='upsert')}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_{table}_log_update AFTER UPDATE OF {watched} ON {table} WHEN OLD.uid IS NOT NULL
+BEGIN
+    {_LOG.format(table=table, uid='NEW.uid', op='upsert')}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_{table}_log_rekey AFTER UPDATE OF uid ON {table} WHEN OLD.uid IS NOT NULL AND OLD.uid IS NOT NEW.uid
+BEGIN
+    {_LOG.format(table=table, uid='OLD.uid', op='delete')}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_{table}_log_delete AFTER DELETE ON {table} WHEN OLD.uid IS NOT NULL
+BEGIN
+    {_LOG.format(table=table, uid='OLD.uid', op='delete')}
+END;
+"""
+
+def init_changelog_db():
+    """
+    uid columns, change log and triggers, safe to call on startup.
+    run after the synced tables exist. rows without a uid (an older database)
+    get one and a log entry, so the first export contains them
+    """
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.executescript(SCHEMA)
+        dbmod.add_missing_columns(cur, [(table, 'uid', 'TEXT') for table in TABLES])
+        for table in TABLES:
+            cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_uid ON {table}(uid)')
+            cur.execute(f'UPDATE {table} SET uid = {_NEW_UID.get(table, _RANDOM_UID).format(r=table)} WHERE uid IS NULL')
+            if cur.rowcount > 0:
+                cur.execute(f"""
+                    INSERT INTO change_log (tbl, uid, op, changed_at, origin)
+                    SELECT '{table}', uid, 'upsert', strftime('%Y-%m-%d %H:%M:%f', 'now'), (SELECT device_id FROM sync_device WHERE id = 1)
+                    FROM {table} t WHERE NOT EXISTS (SELECT 1 FROM change_log c WHERE c.tbl = '{table}' AND c.uid = t.uid)
+                """)
+            cur.executescript(_triggers(table))
+        conn.commit()
+
+def device_id():
+    with dbmod.get_conn() as conn:
+        return conn.execute('SELECT device_id FROM sync_device WHERE id = 1').fetchone()[0]
+
+def new_device_id():
+    """
+    give this database its own device id, needed when it started as a copy of
+    another device's file. returns the new id
+    """
+    with dbmod.get_conn() as conn:
+        conn.execute('UPDATE sync_device SET device_id = lower(hex(randomblob(8))) WHERE id = 1')
+        conn.commit()
+    return device_id()
+
+def list_peers():
+    with dbmod.get_conn() as conn:
+        rows = conn.execute('SELECT device_id, received_seq, sent_seq, last_sync FROM sync_peers ORDER BY device_id').fetchall()
+    return [dict(r) for r in rows]
+
+# -------------------------
+# export / apply
+# -------------------------
+FORMAT = 1
+
+def _select_changes(cur, table, since, peer):
+    """log entries of one table after since, with the rows' current values"""
+    columns, refs = TABLES[table]
+    select = [f't.{c}' for c in columns] + [f'r{i}.uid AS {c}' for i, (c, _) in enumerate(refs)]
+    joins = ''.join(f' LEFT JOIN {ref} r{i} ON r{i}.id = t.{c}' for i, (c, ref) in enumerate(refs))
+    # changes that came from the peer itself are not sent back
+    cur.execute(f"""
+        SELECT c.seq, c.uid, c.op, c.changed_at, c.origin, {', '.join(select)}
+        FROM change_log c LEFT JOIN {table} t ON t.uid = c.uid{joins}
+        WHERE c.seq > ? AND c.tbl = ? AND c.origin IS NOT ?
+    """, (since, table, peer))
+    keys = columns + [c for c, _ in refs]
+    for r in cur.fetchall():
+        change = {'seq': r['seq'], 'table': table, 'uid': r['uid'], 'op': r['op'], 'changed_at': r['changed_at'], 'origin': r['origin']}
+        if r['op'] == 'upsert':
+            # DATE columns come back as date objects (PARSE_DECLTYPES), stored as text again on apply
+            change['row'] = {k: r[k].isoformat() if hasattr(r[k], 'isoformat') else r[k] for k in keys}
+        yield change
+
+def export_changes(peer=None, since=None):
+    """
+    changeset with the rows changed after `since`. default: after the seq the peer
+    (a device id) last confirmed, everything for an unknown or no peer
+    """
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        # one snapshot for all tables
+        if not conn.in_transaction:
+            cur.execute('BEGIN')
+        try:
+            device = cur.execute('SELECT device_id FROM sync_device WHERE id = 1').fetchone()[0]
+            if since is None:
+                row = cur.execute('SELECT sent_seq FROM sync_peers WHERE device_id = ?', (peer,)).fetchone()
+                since = row['sent_seq'] if row else 0
+            until = cur.execute('SELECT IFNULL(MAX(seq), 0) FROM change_log').fetchone()[0]
+            changes = [c for table in TABLES for c in _select_changes(cur, table, since, peer)]
+            acks = {r['device_id']: r['received_seq'] for r in cur.execute('SELECT device_id, received_seq FROM sync_peers')}
+        finally:
+            conn.commit()
+    changes.sort(key=lambda c: c['seq'])
+    return {'format': FORMAT, 'device': device, 'peer': peer, 'since': since, 'until': max(until, since),
+            'acks': acks, 'changes': changes}
+
+def _record(cur, table, uid, op, changed_at, origin):
+    """set a row's log entry to the version it came with (replaces what the triggers logged)"""
+    cur.execute('DELETE FROM change_log WHERE tbl = ? AND uid = ?', (table, uid))
+    cur.execute('INSERT INTO change_log (tbl, uid, op, changed_at, origin) VALUES (?, ?, ?, ?, ?)',
+                (table, uid, op, changed_at, origin))
+
+def _is_newer(cur, change):
+    """
+    last writer wins, per row: the later changed_at, the larger device id on a tie.
+    both devices compare the same two versions, so they keep the same one
+    """
+    local = cur.execute('SELECT changed_at, origin FROM change_log WHERE tbl = ? AND uid = ?',
+                        (change['table'], change['uid'])).fetchone()
+    return local is None or (change['changed_at'], change['origin']) > (local['changed_at'], local['origin'])
+
+def _upsert(cur, table, uid, row):
+    columns, refs = TABLES[table]
+    values = [row.get(c) for c in columns]
+    for column, ref in refs:
+        ref_uid = row.get(column)
+        found = cur.execute(f'SELECT id FROM {ref} WHERE uid = ?', (ref_uid,)).fetchone() if ref_uid else None
+        if ref_uid and found is None and table == 'category_keywords':
+            raise LookupError(f'unknown category {ref_uid}')
+        values.append(found['id'] if found else None)
+    names = columns + [c for c, _ in refs]
+    existing = cur.execute(f'SELECT id FROM {table} WHERE uid = ?', (uid,)).fetchone()
+    if existing:
+        cur.execute(f"UPDATE {table} SET {', '.join(f'{n} = ?' for n in names)} WHERE id = ?", values + [existing['id']])
+    else:
+        cur.execute(f"INSERT INTO {table} (uid, {', '.join(names)}) VALUES ({', '.join('?' * (len(names) + 1))})", [uid] + values)
+
+def apply_changes(changeset):
+    """
+    apply a changeset exported by another device, in one transaction.
+    a change is only applied when it is newer than this device's version of the row.
+    returns counts of applied / skipped (older or same) changes and the conflicts
+    that could not be applied (e.g. a category name that is taken by another category)
+    """
+    if changeset.get('format') != FORMAT:
+        raise ValueError(f"unsupported changeset format {changeset.get('format')!r}")
+    unknown = {c['table'] for c in changeset['changes']} - set(TABLES)
+    if unknown:
+        raise ValueError(f'unknown tables in changeset: {sorted(unknown)}')
+    order = list(TABLES)
+    upserts = sorted((c for c in changeset['changes'] if c['op'] == 'upsert'), key=lambda c: (order.index(c['table']), c['seq']))
+    deletes = sorted((c for c in changeset['changes'] if c['op'] == 'delete'), key=lambda c: (-order.index(c['table']), c['seq']))
+
+    report = {'applied': 0, 'skipped': 0, 'conflicts': []}
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        device = cur.execute('SELECT device_id FROM sync_device WHERE id = 1').fetchone()[0]
+        source = changeset['device']
+        if source == device:
+            raise ValueError('changeset was exported by this database (a copied file? run flask sync-device --reset on one of them)')
+        cur.execute('INSERT OR IGNORE INTO sync_peers (device_id) VALUES (?)', (source,))
+        received = cur.execute('SELECT received_seq FROM sync_peers WHERE device_id = ?', (source,)).fetchone()[0]
+        if changeset['since'] > received:
+            conn.rollback()
+            raise ValueError(f"changeset starts after seq {changeset['since']}, but changes of {source} are only applied up to {received}: "
+                             f"export again with --since {received}")
+
+        for change in upserts + deletes:
+            table, uid = change['table'], change['uid']
+            if not _is_newer(cur, change):
+                report['skipped'] += 1
+                continue
+            try:
+                if change['op'] == 'upsert':
+                    _upsert(cur, table, uid, change['row'])
+                else:
+                    cur.execute(f'DELETE FROM {table} WHERE uid = ?', (uid,))
+            except (sqlite3.IntegrityError, LookupError) as e:
+                report['conflicts'].append(f'{table} {uid}: {e}')
+                continue
+            _record(cur, table, uid, change['op'], change['changed_at'], change['origin'])
+            report['applied'] += 1
+
+        cur.execute("""
+            UPDATE sync_peers SET received_seq = MAX(received_seq, ?), sent_seq = MAX(sent_seq, ?), last_sync = ?
+            WHERE device_id = ?
+        """, (changeset['until'], changeset.get('acks', {}).get(device, 0), time.strftime('%Y-%m-%d %H:%M:%S'), source))
+        conn.commit()
+    return report
+
+def write_changeset(path, changeset):
+    """json file, gzip compressed when the name ends with .gz"""
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as f:
+        json.dump(changeset, f, ensure_ascii=False, separators=(',', ':'))
+
+def read_changeset(path):
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
@@ -1,8 +1,13 @@
+import atexit
 import sqlite3
+import threading
+import time
 from os import makedirs
 from os.path import join, dirname, exists
 from contextlib import contextmanager
 
+from backend import metrics
+
 # -------------------------
 # setup database
 # -------------------------
@@ -13,66 +18,359 @@ CREATE TABLE IF NOT EXISTS expenses (
     id INTEGER PRIMARY KEY,
     date TEXT,
     description TEXT,
-    amount REAL,
-    category TEXT,
-    is_expense INTEGER
+    amount_cents INTEGER,
+    abs_amount_cents INTEGER GENERATED ALWAYS AS (abs(amount_cents)) VIRTUAL,
+    category_id INTEGER REFERENCES categories(id) ON DELETE SET NULL,
+    is_expense INTEGER,
+    automation_id INTEGER,
+    occurrence TEXT
 );
 '''
 
-# indexes for faster queries
+# columns added after the first release, added to older databases by init_db()
+# automation_id + occurrence link a generated row to the automation and month it was created for
+COLUMNS = [
+    ('expenses', 'automation_id', 'INTEGER'),
+    ('expenses', 'occurrence', 'TEXT'),
+    ('expenses', 'category_id', 'INTEGER REFERENCES categories(id) ON DELETE SET NULL'),
+    # amounts in integer cents (signed, expenses negative), sums are exact
+    ('expenses', 'amount_cents', 'INTEGER'),
+    ('expenses', 'abs_amount_cents', 'INTEGER GENERATED ALWAYS AS (abs(amount_cents)) VIRTUAL'),
+]
+
+# expenses with the category name joined back in, for reads that show or sort by it.
+# category is '' for uncategorized rows, like the old free text column mostly was.
+# amount is the stored cents as a decimal number again
+VIEWS = '''
+CREATE VIEW IF NOT EXISTS expenses_view AS
+SELECT e.id, e.date, e.description, e.amount_cents / 100.0 AS amount, e.amount_cents, e.abs_amount_cents,
+       e.category_id, COALESCE(c.name, '') AS category, e.is_expense, e.automation_id, e.occurrence
+FROM expenses e
+LEFT JOIN categories c ON c.id = e.category_id;
+'''
+
+# indexes for faster queries. the *_cover indexes hold every column the
+# totals, dashboard and analytics queries read (is_expense, category_id, amount_cents),
+# so those run on the index alone; benchmarks/plans.py checks the plans
 INDEXES = [
+    # transaction list order (date, id)
     'CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(date);',
-    'CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses(category);',
-    'CREATE INDEX IF NOT EXISTS idx_expenses_amount ON expenses(amount);'
+    # time filtered totals
+    'CREATE INDEX IF NOT EXISTS idx_expenses_date_cover ON expenses(date, is_expense, category_id, amount_cents);',
+    # category filter and the automation duplicate check, also the ON DELETE SET NULL lookup
+    'CREATE INDEX IF NOT EXISTS idx_expenses_category_cover ON expenses(category_id, date, is_expense, amount_cents);',
+    'CREATE INDEX IF NOT EXISTS idx_expenses_amount_cents ON expenses(amount_cents);',
+    # amount search matches both signs, a range on this index (see utils.amount_filter).
+    # sqlite never reads a virtual column from an index alone, so no covering variant
+    'CREATE INDEX IF NOT EXISTS idx_expenses_abs_amount ON expenses(abs_amount_cents);',
+    # one generated row per automation and occurrence, makes re-running automations idempotent
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_automation ON expenses(automation_id, occurrence) WHERE automation_id IS NOT NULL;'
 ]
 
+# replaced by one of the above
+OBSOLETE_INDEXES = ['idx_expenses_category_id']
+
+# write sequence: one counter bumped by every change to expenses or categories,
+# a cheap "has anything changed?" check for http caching (ETag)
+WRITE_SEQ = [
+    'CREATE TABLE IF NOT EXISTS write_seq (id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL)',
+    'INSERT OR IGNORE INTO write_seq (id, seq) VALUES (1, 0)',
+] + [
+    f'CREATE TRIGGER IF NOT EXISTS trg_{table}_seq_{op.lower()} AFTER {op} ON {table} '
+    f'BEGIN UPDATE write_seq SET seq = seq + 1 WHERE id = 1; END'
+    for table in ('expenses', 'categories') for op in ('INSERT', 'UPDATE', 'DELETE')
+]
+
+# connection settings, applied once when a connection is opened
+# override with configure(), e.g. configure(cache_size=-64000)
+PRAGMAS = {
+    'journal_mode': 'WAL',      # readers (dashboard) don't block the writer
+    'busy_timeout': 5000,       # ms to wait for a lock instead of failing
+    'synchronous': 'NORMAL',    # safe with WAL, far fewer fsyncs
+    'cache_size': -32000,       # negative = KiB, ~32 MB page cache
+    'mmap_size': 268435456,     # 256 MB memory mapped reads
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+
+POOL_SIZE = 8  # idle connections kept open per db path
+
+_pool = {}           # path -> list of idle connections
+_pool_lock = threading.Lock()
+_generation = 0      # bumped by close_all_conns(), stale connections are dropped on return
+_local = threading.local()  # connection currently checked out by this thread, per path
+
 def ensure_data_dir():
     if not exists(DATA_DIR):
         makedirs(DATA_DIR, exist_ok=True)
 
+def configure(db_path=None, pool_size=None, **pragmas):
+    """
+    change the database path, pool size and/or connection pragmas.
+    idle connections are closed, so the next get_conn() uses the new settings
+    """
+    global DB_PATH, POOL_SIZE
+    if db_path is not None:
+        DB_PATH = db_path
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    PRAGMAS.update(pragmas)
+    close_all_conns()
+
+def _open_conn(path):
+    makedirs(dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, check_same_thread=False,
+                           factory=metrics.connection_factory())
+    conn.row_factory = sqlite3.Row
+    for name, value in PRAGMAS.items():
+        if value is not None:
+            conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+def _checkout(path):
+    with _pool_lock:
+        idle = _pool.get(path)
+        if idle:
+            metrics.record_checkout(opened=False)
+            return idle.pop(), _generation
+        generation = _generation
+    metrics.record_checkout(opened=True)
+    return _open_conn(path), generation
+
+def _checkin(path, conn, generation):
+    try:
+        if conn.in_transaction:
+            # uncommitted work is dropped, same as closing a fresh connection did
+            conn.rollback()
+    except sqlite3.Error:
+        conn.close()
+        return
+    with _pool_lock:
+        idle = _pool.setdefault(path, [])
+        if generation == _generation and len(idle) < POOL_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
 @contextmanager
-def get_conn():
+def get_conn(path=None):
     """
     use as `with get_conn() as conn: cur = conn.cursor(); ...`
+
+    connections come from a small pool and are opened once with PRAGMAS.
+    nested calls in the same thread share the outer connection
     """
-    ensure_data_dir()
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-    conn.row_factory = sqlite3.Row
-    # enable foreign keys
-    conn.execute('PRAGMA foreign_keys = ON')
+    path = path or DB_PATH
+    active = getattr(_local, 'active', None)
+    if active is None:
+        active = _local.active = {}
+
+    if path in active:
+        conn, generation, depth = active[path]
+        active[path] = (conn, generation, depth + 1)
+        try:
+            yield conn
+        finally:
+            active[path] = (conn, generation, depth)
+        return
+
+    conn, generation = _checkout(path)
+    active[path] = (conn, generation, 1)
     try:
         yield conn
     finally:
-        conn.close()
+        del active[path]
+        _checkin(path, conn, generation)
+
+def close_all_conns():
+    """close idle pooled connections, busy ones are closed when they are returned"""
+    global _generation
+    with _pool_lock:
+        _generation += 1
+        idle = [c for conns in _pool.values() for c in conns]
+        _pool.clear()
+    for conn in idle:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+CHECKPOINT_RETRIES = 3  # each attempt also waits up to busy_timeout
+
+def checkpoint(retries=CHECKPOINT_RETRIES):
+    """
+    fold the WAL file back into the main db file, so copying the .db alone is complete.
+    a checkpoint blocked by readers is retried; raises if it never completes, the
+    .db would be missing committed data
+    """
+    for attempt in range(retries):
+        with get_conn() as conn:
+            busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        if not busy:
+            return
+        time.sleep(0.2 * (attempt + 1))
+    raise sqlite3.OperationalError('wal checkpoint stayed busy, the database file is incomplete')
+
+def release_for_replace():
+    """
+    before another file is copied over the db (download sync): fold the WAL in and close
+    the pooled connections. a WAL left next to the db (e.g. after the process was killed)
+    would otherwise be replayed onto the new file. raises if the WAL can't be emptied
+    """
+    if exists(DB_PATH):
+        checkpoint()
+    close_all_conns()
+
+def _shutdown():
+    # leave no WAL behind: checkpoint and close on a normal exit, if this process used the db
+    with _pool_lock:
+        used = DB_PATH in _pool
+    if used and exists(DB_PATH):
+        try:
+            checkpoint(retries=1)
+        except sqlite3.Error:
+            pass
+    close_all_conns()
+
+atexit.register(_shutdown)
+
+def add_missing_columns(cur, columns):
+    """ALTER TABLE ADD COLUMN for every (table, column, decl) the table doesn't have yet"""
+    for table, column, decl in columns:
+        if column not in table_columns(cur, table):
+            cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+def table_columns(cur, table):
+    # table_xinfo also lists generated columns
+    cur.execute(f'PRAGMA table_xinfo({table})')
+    return {r['name'] for r in cur.fetchall()}
+
+def migrate_category_names(cur, table):
+    """
+    move the free text `category` column of an older table to `category_id`:
+    unknown names become categories, ids are filled in, then the text column is dropped.
+    needs the categories table (init_categories_db) and a category_id column
+    """
+    if 'category' not in table_columns(cur, table):
+        return False
+    cur.execute(f"""
+        INSERT OR IGNORE INTO categories (name)
+        SELECT DISTINCT category FROM {table} WHERE TRIM(IFNULL(category, '')) != ''
+    """)
+    cur.execute(f"""
+        UPDATE {table} SET category_id = (SELECT id FROM categories WHERE name = {table}.category)
+        WHERE category_id IS NULL AND TRIM(IFNULL(category, '')) != ''
+    """)
+    drop_column(cur, table, 'category')
+    return True
+
+def drop_column(cur, table, column):
+    """
+    ALTER TABLE DROP COLUMN, which refuses while an index, view or trigger still uses the column:
+    indexes and triggers of the table that mention it and views that mention the table go first.
+    triggers and views are recreated by the init_* functions that own them
+    """
+    cur.execute("SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql LIKE ?",
+                (table, f'%{column}%'))
+    for r in cur.fetchall():
+        cur.execute(f'DROP {r["type"].upper()} IF EXISTS {r["name"]}')
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'view' AND sql LIKE ?", (f'%{table}%',))
+    for r in cur.fetchall():
+        cur.execute(f'DROP VIEW IF EXISTS {r["name"]}')
+    cur.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+
+BACKFILL_BATCH = 5000
+
+def migrate_amount_to_cents(conn, batch_size=BACKFILL_BATCH):
+    """
+    move the REAL `amount` of an older expenses table to integer `amount_cents`.
+    rows are converted in id ranges, one short transaction per batch, so other
+    connections can keep reading and writing while a large ledger is migrated
+    (and an interrupted run just continues). then the old column is dropped
+    """
+    cur = conn.cursor()
+    if 'amount' not in table_columns(cur, 'expenses'):
+        return False
+    conn.commit()
+    cur.execute('SELECT IFNULL(MAX(id), 0) FROM expenses')
+    max_id = cur.fetchone()[0]
+    for lo in range(0, max_id, batch_size):
+        cur.execute("""
+            UPDATE expenses SET amount_cents = CAST(ROUND(amount * 100) AS INTEGER)
+            WHERE id > ? AND id <= ? AND amount_cents IS NULL AND amount IS NOT NULL
+        """, (lo, lo + batch_size))
+        conn.commit()
+    # rows written meanwhile, then the column goes in the same transaction
+    cur.execute('UPDATE expenses SET amount_cents = CAST(ROUND(amount * 100) AS INTEGER) WHERE amount_cents IS NULL AND amount IS NOT NULL')
+    drop_column(cur, 'expenses', 'amount')
+    conn.commit()
+    return True
 
 def init_db():
-    """create schema and indexes, safe to call on startup"""
+    """
+    create schema, indexes and views, safe to call on startup.
+    run init_categories_db() first, expenses reference categories
+    """
     with get_conn() as conn:
         cur = conn.cursor()
         cur.executescript(SCHEMA)
+        add_missing_columns(cur, COLUMNS)
+        migrate_category_names(cur, 'expenses')
+        migrate_amount_to_cents(conn)
+        for name in OBSOLETE_INDEXES:
+            cur.execute(f'DROP INDEX IF EXISTS {name}')
         for idx_sql in INDEXES:
             cur.execute(idx_sql)
+        cur.execute(VIEWS)
+        for sql in WRITE_SEQ:
+            cur.execute(sql)
         conn.commit()
 
+def optimize():
+    """
+    refresh the planner statistics: a full (sampled) ANALYZE the first time,
+    afterwards PRAGMA optimize, which only re-analyzes tables that changed a lot
+    """
+    with get_conn() as conn:
+        conn.execute('PRAGMA analysis_limit = 1000')
+        has_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+        # 0x10002: analyze if needed, looking at all tables, not only the ones this connection used
+        conn.execute('PRAGMA optimize = 0x10002' if has_stats else 'ANALYZE')
+        conn.commit()
+
+def write_seq():
+    """current value of the write sequence, changes with every write to expenses / categories"""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT seq FROM write_seq WHERE id = 1')
+        row = cur.fetchone()
+    return row['seq'] if row else 0
+
 # -------------------------
 # CRUD helpers
 # -------------------------
-def insert_transaction(date, description, amount, category, is_expense=1):
+def to_cents(amount):
+    """amount (number or numeric string) -> integer cents, None stays None"""
+    if amount is None:
+        return None
+    return int(round(float(amount) * 100))
+
+def insert_transaction(date, description, amount, category_id, is_expense=1):
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(
-            'INSERT INTO expenses (date, description, amount, category, is_expense) VALUES (?, ?, ?, ?, ?)',
-            (date, description, amount, category, is_expense)
+            'INSERT INTO expenses (date, description, amount_cents, category_id, is_expense) VALUES (?, ?, ?, ?, ?)',
+            (date, description, to_cents(amount), category_id, is_expense)
         )
         conn.commit()
         return cur.lastrowid
 
-def update_transaction(tx_id, date, description, amount, category, is_expense):
+def update_transaction(tx_id, date, description, amount, category_id, is_expense):
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(
-            'UPDATE expenses SET date=?, description=?, amount=?, category=?, is_expense=? WHERE id=?',
-            (date, description, amount, category, is_expense, tx_id)
+            'UPDATE expenses SET date=?, description=?, amount_cents=?, category_id=?, is_expense=? WHERE id=?',
+            (date, description, to_cents(amount), category_id, is_expense, tx_id)
         )
         conn.commit()
 
@@ -86,26 +384,123 @@ def delete_transaction(tx_id):
 def get_transaction(tx_id):
     with get_conn() as conn:
         cur = conn.cursor()
-        cur.execute('SELECT * FROM expenses WHERE id=?', (tx_id,))
+        cur.execute('SELECT * FROM expenses_view WHERE id=?', (tx_id,))
         return cur.fetchone()
     
 # safe query helper: whitelist order_by column names
 _VALID_ORDER_COLUMNS = {'date','amount','description','category','id'}
+# sort keys that are stored under another (indexed) column
+_ORDER_COLUMN_SQL = {'amount': 'amount_cents'}
+
+# page size for the transaction list, the request can ask for less but never more
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
-def query_transactions(where_clause='', params=(), order_by='date'):
-    if order_by not in _VALID_ORDER_COLUMNS:
+def _keyset_condition(order_by, direction, after):
+    """
+    WHERE condition for the rows after `after` = (value, id) in the (order_by, id) order.
+    SQLite sorts NULL first, so NULL values need their own branch
+    """
+    value, last_id = after
+    if order_by == 'id':
+        return ('id < ?' if direction == 'DESC' else 'id > ?'), [last_id]
+    if direction == 'DESC':
+        if value is None:
+            return f'({order_by} IS NULL AND id < ?)', [last_id]
+        return f'({order_by} < ? OR ({order_by} = ? AND id < ?) OR {order_by} IS NULL)', [value, value, last_id]
+    if value is None:
+        return f'(({order_by} IS NULL AND id > ?) OR {order_by} IS NOT NULL)', [last_id]
+    return f'({order_by} > ? OR ({order_by} = ? AND id > ?))', [value, value, last_id]
+
+def _transactions_sql(where_clause, params, order_by, limit, after, match):
+    """SELECT for query_transactions / iter_transactions, returns (sql, params)"""
+    if order_by == 'relevance' and match is None:
+        order_by = 'date'
+    if order_by not in _VALID_ORDER_COLUMNS and order_by != 'relevance':
         order_by = 'date'
     direction = 'DESC' if order_by == 'date' else 'ASC'
-    q = 'SELECT * FROM expenses ' + (where_clause or '') + f' ORDER BY {order_by} {direction}'
+    params = list(params)
+
+    if order_by == 'relevance':
+        # bm25 rank of the fts index, lower is a better match
+        q = ('SELECT expenses_view.*, f.rank AS relevance FROM expenses_view '
+             'JOIN (SELECT rowid AS fts_id, rank FROM expenses_fts WHERE expenses_fts MATCH ?) f ON f.fts_id = expenses_view.id ')
+        params.insert(0, match)
+        order_expr = 'f.rank'
+    else:
+        q = 'SELECT * FROM expenses_view '
+        order_expr = _ORDER_COLUMN_SQL.get(order_by, order_by)
+    q += where_clause or ''
+
+    if after is not None:
+        cond, cond_params = _keyset_condition(order_expr, direction, after)
+        q += (' AND ' if where_clause else ' WHERE ') + cond
+        params.extend(cond_params)
+    q += f' ORDER BY {order_expr} {direction}'
+    if order_by != 'id':
+        q += f', id {direction}'
+    if limit is not None:
+        q += ' LIMIT ?'
+        params.append(int(limit))
+    return q, params
+
+def query_transactions(where_clause='', params=(), order_by='date', limit=None, after=None, match=None):
+    """
+    limit: max rows to return (None = all)
+    after: (order value, id) of the last row already shown, for keyset pagination
+    match: fts5 MATCH expression, needed for order_by='relevance' (best match first)
+    """
+    q, params = _transactions_sql(where_clause, params, order_by, limit, after, match)
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(q, params)
         return cur.fetchall()
 
-def sum_query(where_clause='', params=()):
-    q = 'SELECT SUM(amount) as total FROM expenses ' + (where_clause or '')
+def iter_transactions(where_clause='', params=(), order_by='date', match=None, batch_size=500):
+    """
+    generator over every matching row. rows are pulled from one open cursor
+    batch by batch, so memory stays flat however many rows match
+    """
+    q, params = _transactions_sql(where_clause, params, order_by, None, None, match)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(q, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cur.close()
+
+def query_transactions_page(where_clause='', params=(), order_by='date', page_size=PAGE_SIZE, after=None, match=None):
+    """
+    one page of transactions, returns (rows, next_after).
+    next_after is None on the last page, otherwise pass it back as `after`
+    """
+    if order_by == 'relevance' and match is None:
+        order_by = 'date'
+    if order_by not in _VALID_ORDER_COLUMNS and order_by != 'relevance':
+        order_by = 'date'
+    page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+    # fetch one extra row to know whether there is a next page
+    rows = query_transactions(where_clause, params, order_by, limit=page_size + 1, after=after, match=match)
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, (last[_ORDER_COLUMN_SQL.get(order_by, order_by)], last['id'])
+
+def summary_query(where_clause='', params=()):
+    """total amount and number of rows for the whole filter, in one scan"""
+    q = 'SELECT SUM(amount_cents) as total, COUNT(*) as n FROM expenses ' + (where_clause or '')
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(q, params)
         row = cur.fetchone()
-    return row['total'] if row and row['total'] is not None else 0.0
\ No newline at end of file
+    total = row['total'] / 100 if row and row['total'] is not None else 0.0
+    return {'total': total, 'count': row['n'] if row else 0}
+
+def sum_query(where_clause='', params=()):
+    return summary_query(where_clause, params)['total']
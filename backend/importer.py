@@ -0,0 +1,189 @@
+import csv
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from backend import db as dbmod
+from backend import rates
+from backend.utils import keyword_categorizer
+from backend.categories import category_id_for
+
+# csv column for each transaction field, None = not present in the file.
+# without an is_expense column the sign of the amount decides (negative = expense)
+DEFAULT_MAPPING = {
+    'date': 'date',
+    'description': 'description',
+    'amount': 'amount',
+    'category': None,
+    'currency': None,
+    'is_expense': None,
+}
+CHUNK_SIZE = 1000
+SPOOL_BYTES = 8 * 1024 * 1024  # a file that can't seek is copied for the rates pass, to disk above this
+MAX_ERRORS = 20  # row errors kept in the report, the rest are only counted
+
+_EXPENSE_VALUES = {'1', 'expense', 'debit', 'd', 'out', '-'}
+
+def _parse_amount(raw, decimal):
+    """'1.234,56 €' (decimal=',') or '-1,234.56' (decimal='.') -> float"""
+    s = ''.join(ch for ch in str(raw) if ch.isdigit() or ch in ',.-+')
+    if decimal == ',':
+        s = s.replace('.', '').replace(',', '.')
+    else:
+        s = s.replace(',', '')
+    return float(s)
+
+def _parse_row(row, mapping, date_format, decimal, default_currency):
+    """csv dict row -> (date, description, signed amount, category, currency, is_expense)"""
+    def col(field):
+        name = mapping.get(field)
+        return (row.get(name) or '').strip() if name else ''
+
+    date_str = datetime.strptime(col('date'), date_format).strftime('%Y-%m-%d')
+    description = col('description')
+    if description == '':
+        raise ValueError('description is empty')
+    amount = _parse_amount(col('amount'), decimal)
+
+    flag = col('is_expense').lower()
+    if flag:
+        is_expense = 1 if flag in _EXPENSE_VALUES else 0
+    else:
+        is_expense = 1 if amount < 0 else 0
+
+    currency = (col('currency') or default_currency).strip().lower()
+    return date_str, description, abs(amount), col('category'), currency, is_expense
+
+def _rewindable(fileobj):
+    """the file itself if it can seek back, otherwise a temporary copy (on disk when large)"""
+    try:
+        if fileobj.seekable():
+            return fileobj, fileobj.tell()
+    except (AttributeError, OSError):
+        pass
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES, mode='w+', newline='', encoding='utf-8')
+    shutil.copyfileobj(fileobj, spool)
+    spool.seek(0)
+    return spool, 0
+
+def _load_rates(rows, parse, main_ccy):
+    """
+    rate tables for every (currency, date) the file needs, keyed by that pair.
+    runs before the import's write transaction, so no http request holds the db lock
+    """
+    pairs = set()
+    for row in rows:
+        try:
+            date_str, _, _, _, currency, _ = parse(row)
+        except Exception:
+            continue  # reported by the import pass
+        if currency != main_ccy:
+            pairs.add((currency, date_str))
+    if pairs:
+        # download in parallel, then read them (and retry any misses) one by one
+        rates.prefetch(pairs)
+    return {pair: rates.get_rates_for(*pair) for pair in pairs}
+
+def _convert_chunk(parsed, main_ccy, rate_cache):
+    """convert amounts to the main currency with the rates loaded by _load_rates"""
+    out = []
+    for date_str, description, amount, category, currency, is_expense in parsed:
+        if currency != main_ccy:
+            rate = (rate_cache.get((currency, date_str)) or {}).get(main_ccy)
+            if rate is None:
+                raise RuntimeError(f'No rate {currency}->{main_ccy}')
+            amount = round(amount * rate, 2)
+        out.append((date_str, description, amount, category, is_expense))
+    return out
+
+def _insert_chunk(cur, chunk, category_ids, categorize):
+    """autocategorize + executemany one chunk of converted rows, category_ids caches name -> id"""
+    missing = [i for i, row in enumerate(chunk) if row[3] == '']
+    guessed = categorize([chunk[i][1] for i in missing])
+    chunk = list(chunk)
+    for i, category in zip(missing, guessed):
+        date_str, description, amount, _, is_expense = chunk[i]
+        chunk[i] = (date_str, description, amount, category, is_expense)
+
+    for row in chunk:
+        if row[3] not in category_ids:
+            category_ids[row[3]] = category_id_for(row[3])
+
+    cur.executemany(
+        'INSERT INTO expenses (date, description, amount_cents, category_id, is_expense) VALUES (?, ?, ?, ?, ?)',
+        [(d, desc, dbmod.to_cents(-abs(amt) if is_exp else abs(amt)), category_ids[cat], is_exp) for d, desc, amt, cat, is_exp in chunk]
+    )
+
+def import_csv(fileobj, mapping=None, main_currency='EUR', default_currency=None,
+               date_format='%Y-%m-%d', delimiter=',', decimal='.', chunk_size=CHUNK_SIZE, progress=None):
+    """
+    stream a bank statement csv (text file object) into expenses.
+
+    rows are read one by one and inserted in chunks with executemany, all inside
+    one transaction, so a failing import leaves the db untouched. rows that can't
+    be parsed are skipped and reported. when amounts may need converting, a first
+    pass collects the (currency, date) pairs and loads their rates before that
+    transaction starts.
+    progress: optional callback(rows_imported, seconds_elapsed) called after every chunk
+    returns {'imported', 'skipped', 'errors', 'seconds', 'rows_per_sec'}
+    """
+    fields = dict(DEFAULT_MAPPING)
+    fields.update(mapping or {})
+    main_ccy = main_currency.strip().lower()
+    default_ccy = (default_currency or main_currency).strip().lower()
+
+    started = time.perf_counter()
+    rate_cache = {}
+    if fields.get('currency') or default_ccy != main_ccy:
+        fileobj, start = _rewindable(fileobj)
+        rate_cache = _load_rates(csv.DictReader(fileobj, delimiter=delimiter),
+                                 lambda row: _parse_row(row, fields, date_format, decimal, default_ccy), main_ccy)
+        fileobj.seek(start)
+
+    reader = csv.DictReader(fileobj, delimiter=delimiter)
+    imported = skipped = 0
+    errors = []
+    category_ids = {}
+    parsed = []
+    # built before the transaction: inside it, once category_id_for created a category, the
+    # matcher would be rebuilt for every chunk. the categories an import creates have no keywords
+    categorize = keyword_categorizer()
+
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        try:
+            for line_no, row in enumerate(reader, start=2):  # line 1 is the header
+                try:
+                    parsed.append(_parse_row(row, fields, date_format, decimal, default_ccy))
+                except Exception as e:
+                    skipped += 1
+                    if len(errors) < MAX_ERRORS:
+                        errors.append(f'line {line_no}: {e}')
+                    continue
+
+                if len(parsed) >= chunk_size:
+                    _insert_chunk(cur, _convert_chunk(parsed, main_ccy, rate_cache), category_ids, categorize)
+                    imported += len(parsed)
+                    parsed = []
+                    if progress:
+                        progress(imported, time.perf_counter() - started)
+
+            if parsed:
+                _insert_chunk(cur, _convert_chunk(parsed, main_ccy, rate_cache), category_ids, categorize)
+                imported += len(parsed)
+                if progress:
+                    progress(imported, time.perf_counter() - started)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    seconds = time.perf_counter() - started
+    return {
+        'imported': imported,
+        'skipped': skipped,
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(imported / seconds, 1) if seconds > 0 else float(imported),
+    }
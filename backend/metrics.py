@@ -0,0 +1,257 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# in-process request metrics, exposed in prometheus text format at /metrics.
+# per request: wall time, sql statements / time, get_conn checkouts and rates http time.
+# every worker process keeps its own numbers
+ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+# statements slower than this (ms) are printed with their query plan, empty = off
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS') or 0) or None
+
+PREFIX = 'expense_tracker'
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# -------------------------
+# histograms & counters
+# -------------------------
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value):
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.n += 1
+
+_lock = threading.Lock()
+_histograms = {}  # name -> {labels tuple: Histogram}
+_counters = {}    # name -> {labels tuple: value}
+_gauges = {}      # name -> {labels tuple: value}, set to the current value
+_help = {}
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(name, value, buckets=SECONDS_BUCKETS, help='', **labels):
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        hist = series.get(_labels(labels))
+        if hist is None:
+            hist = series[_labels(labels)] = Histogram(buckets)
+        hist.observe(value)
+        _help.setdefault(name, help)
+
+def inc(name, value=1, help='', **labels):
+    with _lock:
+        series = _counters.setdefault(name, {})
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + value
+        _help.setdefault(name, help)
+
+def gauge(name, value, help='', **labels):
+    with _lock:
+        _gauges.setdefault(name, {})[_labels(labels)] = value
+        _help.setdefault(name, help)
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+def _fmt_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+def render():
+    """all metrics in the prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for name, series in sorted(_counters.items()):
+            full = f'{PREFIX}_{name}'
+            if _help.get(name):
+                lines.append(f'# HELP {full} {_help[name]}')
+            lines.append(f'# TYPE {full} counter')
+            for labels, value in sorted(series.items()):
+                lines.append(f'{full}{_fmt_labels(labels)} {value}')
+        for name, series in sorted(_gauges.items()):
+            full = f'{PREFIX}_{name}'
+            if _help.get(name):
+                lines.append(f'# HELP {full} {_help[name]}')
+            lines.append(f'# TYPE {full} gauge')
+            for labels, value in sorted(series.items()):
+                lines.append(f'{full}{_fmt_labels(labels)} {value}')
+        for name, series in sorted(_histograms.items()):
+            full = f'{PREFIX}_{name}'
+            if _help.get(name):
+                lines.append(f'# HELP {full} {_help[name]}')
+            lines.append(f'# TYPE {full} histogram')
+            for labels, hist in sorted(series.items()):
+                cumulative = 0
+                for le, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(f'{full}_bucket{_fmt_labels(labels, [("le", le)])} {cumulative}')
+                lines.append(f'{full}_bucket{_fmt_labels(labels, [("le", "+Inf")])} {hist.n}')
+                lines.append(f'{full}_sum{_fmt_labels(labels)} {round(hist.total, 6)}')
+                lines.append(f'{full}_count{_fmt_labels(labels)} {hist.n}')
+    return '\n'.join(lines) + '\n'
+
+# -------------------------
+# per request
+# -------------------------
+_local = threading.local()
+
+def _request():
+    return getattr(_local, 'request', None)
+
+def begin_request():
+    _local.request = {'started': time.perf_counter(), 'sql_statements': 0, 'sql_seconds': 0.0,
+                      'connections': 0, 'rates_http_seconds': 0.0}
+
+def end_request(route, method, status):
+    """record the numbers of the request that runs in this thread"""
+    req = _request()
+    _local.request = None
+    if req is None:
+        return
+    inc('requests_total', help='http requests', route=route, method=method, status=status)
+    observe('request_seconds', time.perf_counter() - req['started'], help='wall time per request', route=route, method=method)
+    observe('request_sql_statements', req['sql_statements'], COUNT_BUCKETS, help='sql statements per request', route=route)
+    observe('request_sql_seconds', req['sql_seconds'], help='time spent in sqlite per request', route=route)
+    observe('request_connections', req['connections'], COUNT_BUCKETS, help='dbmod.get_conn checkouts per request', route=route)
+    observe('request_rates_http_seconds', req['rates_http_seconds'], help='time spent fetching exchange rates per request', route=route)
+
+def add_request_time(key, seconds):
+    req = _request()
+    if req is not None:
+        req[key] += seconds
+
+def record_checkout(opened):
+    """a get_conn() checkout (nested calls excluded), opened=True if a new connection was made"""
+    if not ENABLED:
+        return
+    req = _request()
+    if req is not None:
+        req['connections'] += 1
+    if opened:
+        inc('sql_connections_opened_total', help='sqlite connections opened')
+
+def record_rates_http(seconds, ok):
+    """one http request of the rates module (any thread)"""
+    if not ENABLED:
+        return
+    inc('rates_http_requests_total', help='exchange rate http requests', ok=str(ok).lower())
+    observe('rates_http_request_seconds', seconds, help='duration of one exchange rate http request')
+    add_request_time('rates_http_seconds', seconds)
+
+# -------------------------
+# sqlite
+# -------------------------
+def _record_sql(conn, sql, params, seconds, statement=True):
+    if statement:
+        inc('sql_statements_total', help='sql statements executed')
+    req = _request()
+    if req is not None:
+        req['sql_seconds'] += seconds
+        if statement:
+            req['sql_statements'] += 1
+    if statement and SLOW_QUERY_MS is not None and seconds * 1000 >= SLOW_QUERY_MS:
+        _log_slow(conn, sql, params, seconds)
+
+def _log_slow(conn, sql, params, seconds):
+    plan = []
+    if sql.lstrip()[:6].upper() in ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT'):
+        try:
+            # plain Connection.execute, not counted and not timed again
+            rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params or ())
+            plan = [f'  {r[3]}' for r in rows.fetchall()]
+        except sqlite3.Error as e:
+            plan = [f'  (no plan: {e})']
+    text = ' '.join(sql.split())
+    if len(text) > 500:
+        text = text[:500] + ' ...'
+    print(f'Slow query ({seconds * 1000:.1f} ms): {text}', *plan, sep='\n', file=sys.stderr)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """cursor that times execute and fetch calls"""
+
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _record_sql(self.connection, sql, params, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_of_params):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            _record_sql(self.connection, sql, None, time.perf_counter() - t0)
+
+    def executescript(self, script):
+        t0 = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            _record_sql(self.connection, script, None, time.perf_counter() - t0)
+
+    # sqlite does most of the work of a query while rows are stepped through
+    def fetchone(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _record_sql(self.connection, None, None, time.perf_counter() - t0, statement=False)
+
+    def fetchmany(self, size=None):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchmany(size) if size is not None else super().fetchmany()
+        finally:
+            _record_sql(self.connection, None, None, time.perf_counter() - t0, statement=False)
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _record_sql(self.connection, None, None, time.perf_counter() - t0, statement=False)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """connection whose cursors (and shortcut execute methods) are instrumented"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _record_sql(self, 'COMMIT', None, time.perf_counter() - t0)
+
+def connection_factory():
+    return InstrumentedConnection if ENABLED else sqlite3.Connection
@@ -1,59 +1,236 @@
 import json
 import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from pathlib import Path
-import requests
 
-CACHE_PATH = Path('data/rates_cache.json')
-CACHE_TTL = 24 * 3600 # 1 day
+from backend import db as dbmod
+from backend import metrics
+
+CACHE_PATH = Path('data/rates_cache.json')  # old single-date cache, imported once into fx_rates
+# rates are a cache, not ledger data: own db file, so storing rates never commits
+# (or waits on) a caller's open transaction on the main db
+RATES_DB_PATH = str(Path(dbmod.DATA_DIR) / 'rates.db')
+CACHE_TTL = 24 * 3600 # 1 day, only for today's (still moving) rates
+LRU_SIZE = 256  # (base, date) rate tables kept in memory
+HTTP_TIMEOUT = 5  # seconds per request
+PREFETCH_WORKERS = 8  # concurrent downloads in prefetch(), also the http pool size
 JSDELIVR = 'https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@{date}/v1/currencies/{base}.min.json'
 PAGES_DEV = 'https://{date}.currency-api.pages.dev/v1/currencies/{base}.json'
 
 # using https://github.com/fawazahmed0/exchange-api
 
-def _load_cache():
+# -------------------------
+# database
+# -------------------------
+# historical rates never change, so rows are kept forever.
+# primary key order (base, date, quote) makes "all quotes of one day" a range scan
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fx_rates (
+    base TEXT NOT NULL,
+    date TEXT NOT NULL,
+    quote TEXT NOT NULL,
+    rate REAL NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (base, date, quote)
+) WITHOUT ROWID;
+"""
+
+_db_ready = False
+_lru = OrderedDict()  # (base, date) -> (rates dict, fetched_at)
+_lru_lock = threading.Lock()
+
+def init_rates_db():
+    """create the rate store and import the old json cache if there is one"""
+    global _db_ready
+    with dbmod.get_conn(RATES_DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.executescript(SCHEMA)
+        conn.commit()
+    _db_ready = True
+
+    legacy = _load_legacy_cache()
+    for base, entry in legacy.items():
+        if entry.get('rates') and entry.get('date'):
+            _store(base, entry['date'], entry['rates'], entry.get('ts', 0))
+    if legacy:
+        try:
+            CACHE_PATH.rename(CACHE_PATH.with_suffix('.json.imported'))
+        except OSError:
+            pass
+
+def _load_legacy_cache():
     try:
         return json.loads(CACHE_PATH.read_text())
-    except:
+    except Exception:
         return {}
 
+def _ensure_db():
+    if not _db_ready:
+        init_rates_db()
 
-def _save_cache(obj):
-    try:
-        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
-        CACHE_PATH.write_text(json.dumps(obj), encoding='utf-8')
-    except Exception:
-        pass
+def _store(base, date_str, rates, fetched_at):
+    rows = [(base, date_str, quote.lower(), float(rate), fetched_at)
+            for quote, rate in rates.items() if isinstance(rate, (int, float))]
+    with dbmod.get_conn(RATES_DB_PATH) as conn:
+        # a caller's open transaction on this connection is theirs to commit, not ours
+        outer = conn.in_transaction
+        conn.executemany('INSERT OR REPLACE INTO fx_rates (base, date, quote, rate, fetched_at) VALUES (?, ?, ?, ?, ?)', rows)
+        if not outer:
+            conn.commit()
 
-def get_rates_for(base, date_str):
+def _load(base, date_str):
+    """(rates, fetched_at) from the store, or (None, None)"""
+    with dbmod.get_conn(RATES_DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT quote, rate, fetched_at FROM fx_rates WHERE base = ? AND date = ?', (base, date_str))
+        rows = cur.fetchall()
+    if not rows:
+        return None, None
+    return {r['quote']: r['rate'] for r in rows}, min(r['fetched_at'] for r in rows)
+
+def _load_nearest(base, date_str):
+    """closest stored day on or before date_str (any day as last resort), for when fetching fails"""
+    with dbmod.get_conn(RATES_DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT date FROM fx_rates WHERE base = ?
+            ORDER BY date <= ? DESC, CASE WHEN date <= ? THEN date END DESC, date
+            LIMIT 1
+        """, (base, date_str, date_str))
+        row = cur.fetchone()
+    return _load(base, row['date'])[0] if row else None
+
+# -------------------------
+# cache
+# -------------------------
+def _is_fresh(date_str, fetched_at, now):
+    """rates of past days are final, today's (or future) ones expire after CACHE_TTL"""
+    if date_str < date.today().isoformat():
+        return True
+    return now - fetched_at < CACHE_TTL
+
+def _lru_get(key):
+    with _lru_lock:
+        hit = _lru.get(key)
+        if hit is not None:
+            _lru.move_to_end(key)
+        return hit
+
+def _lru_put(key, rates, fetched_at):
+    with _lru_lock:
+        _lru[key] = (rates, fetched_at)
+        _lru.move_to_end(key)
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+
+def get_cached_rates(base, date_str):
+    """rates from memory or the store if they are still valid, else None (no network)"""
     base = base.strip().lower()
     now = time.time()
-    cache = _load_cache()
+    key = (base, date_str)
+
+    hit = _lru_get(key)
+    if hit and _is_fresh(date_str, hit[1], now):
+        return hit[0]
+
+    _ensure_db()
+    rates, fetched_at = _load(base, date_str)
+    if rates and _is_fresh(date_str, fetched_at, now):
+        _lru_put(key, rates, fetched_at)
+        return rates
+    return None
 
-    entry = cache.get(base, {})
-    if entry and now - entry.get('ts', 0) < CACHE_TTL and entry.get('date', '') == date_str:
-        return entry['rates']
+# -------------------------
+# remote
+# -------------------------
+_session = None
+_session_lock = threading.Lock()
 
-    cnt = 0
+def _get_session():
+    """one shared keep-alive session, so repeated fetches reuse their connections"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests  # imported on first fetch, keeps app startup light
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=PREFETCH_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+def _fetch_remote(base, date_str):
+    session = _get_session()
     for url in [JSDELIVR, PAGES_DEV]:
+        t0 = time.perf_counter()
+        ok = False
         try:
-            r = requests.get(url.format(base=base, date=date_str), timeout=5)
+            r = session.get(url.format(base=base, date=date_str), timeout=HTTP_TIMEOUT)
             r.raise_for_status()
+            ok = True
             data = r.json()
             rates = data.get(base.lower())
             if not rates:
                 # for some versions rates may be directly under 'rates' key
                 rates = data.get('rates')
             if rates:
-                cache[base] = {'rates': rates, 'ts': now, 'date' : date_str}
-                _save_cache(cache)
                 return rates
         except Exception:
-            cnt += 1
-            if cnt >= 2:
-                break
+            continue
+        finally:
+            metrics.record_rates_http(time.perf_counter() - t0, ok)
+    return None
+
+def prefetch(pairs, max_workers=None):
+    """
+    make sure rates for every (base, date) pair are in the store.
+    pairs that aren't cached yet are downloaded concurrently over the shared session.
+    returns {'cached': n, 'fetched': n, 'failed': [(base, date), ...]}
+    """
+    wanted = sorted({(b.strip().lower(), d) for b, d in pairs})
+    missing = [(b, d) for b, d in wanted if get_cached_rates(b, d) is None]
+    report = {'cached': len(wanted) - len(missing), 'fetched': 0, 'failed': []}
+    if not missing:
+        return report
+
+    workers = max(1, min(max_workers or PREFETCH_WORKERS, len(missing)))
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fx-prefetch') as pool:
+        results = list(pool.map(lambda pair: _fetch_remote(*pair), missing))
+    # the workers have no request of their own, count the wall time of the downloads for the caller
+    metrics.add_request_time('rates_http_seconds', time.perf_counter() - t0)
+
+    # single writer: store everything from this thread once the downloads are done
+    now = time.time()
+    for (base, date_str), rates in zip(missing, results):
+        if rates:
+            _store(base, date_str, rates, now)
+            _lru_put((base, date_str), {q.lower(): r for q, r in rates.items()}, now)
+            report['fetched'] += 1
+        else:
+            report['failed'].append((base, date_str))
+    return report
+
+def get_rates_for(base, date_str):
+    base = base.strip().lower()
+    rates = get_cached_rates(base, date_str)
+    if rates is not None:
+        return rates
+
+    rates = _fetch_remote(base, date_str)
+    if rates:
+        now = time.time()
+        _store(base, date_str, rates, now)
+        _lru_put((base, date_str), {q.lower(): r for q, r in rates.items()}, now)
+        return rates
 
-    if entry:
-        return entry['rates']
+    # offline: fall back to the closest rates we have
+    fallback = _load_nearest(base, date_str)
+    if fallback:
+        return fallback
     raise RuntimeError('Failed to fetch rates for ' + base)
 
 def convert(amount, from_ccy, to_ccy, date_str):
@@ -67,4 +244,4 @@ def convert(amount, from_ccy, to_ccy, date_str):
     rate = rates.get(to_ccy)
     if rate is None:
         raise RuntimeError(f'No rate {from_ccy}->{to_ccy}')
-    return round(amount * rate, 2)
\ No newline at end of file
+    return round(amount * rate, 2)
@@ -0,0 +1,175 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from backend import db as dbmod
+from backend import automations as auto_mod
+
+# time of day (HH:MM, local) for the daily automation run
+RUN_AT = os.environ.get('AUTOMATIONS_RUN_AT', '03:00')
+# a worker holds the job lease at most this long, so a crashed worker can't block it forever
+LEASE_SECONDS = 15 * 60
+# a wanted run that was skipped (another worker held the lease) or failed (e.g. database locked) is retried this often
+RETRY_SECONDS = 30
+
+# -------------------------
+# database
+# -------------------------
+# one row per job: the lease (owner + expiry) makes sure only one process runs it,
+# the last_* columns are shown on the automations page of every worker
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduler_state (
+    name TEXT PRIMARY KEY,
+    owner TEXT,
+    lease_until REAL,
+    last_run TEXT,
+    last_duration REAL,
+    last_error TEXT
+);
+"""
+
+_owner = f'{socket.gethostname()}:{os.getpid()}'
+_wake = threading.Event()
+_thread = None
+_thread_lock = threading.Lock()
+
+def init_scheduler_db():
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.executescript(SCHEMA)
+        conn.commit()
+
+def _acquire(name):
+    """
+    take the job's lease, returns the owner token of this run or None if it is held.
+    the token is new per run, so the scheduler thread and a manual run of the same
+    process can't both hold the lease
+    """
+    token = f'{_owner}:{uuid.uuid4().hex}'
+    now = time.time()
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('INSERT OR IGNORE INTO scheduler_state (name) VALUES (?)', (name,))
+        cur.execute("""
+            UPDATE scheduler_state SET owner = ?, lease_until = ?
+            WHERE name = ? AND (owner IS NULL OR lease_until IS NULL OR lease_until < ?)
+        """, (token, now + LEASE_SECONDS, name, now))
+        conn.commit()
+        return token if cur.rowcount == 1 else None
+
+def _finish(name, token, started_at, duration, error):
+    with dbmod.get_conn() as conn:
+        conn.execute("""
+            UPDATE scheduler_state
+            SET owner = NULL, lease_until = NULL, last_run = ?, last_duration = ?, last_error = ?
+            WHERE name = ? AND owner = ?
+        """, (started_at, duration, error, name, token))
+        conn.commit()
+
+def run_job(name, func, not_before=None):
+    """
+    run func() if no other worker holds the job's lease and record how it went.
+    not_before: skip if the job already ran at or after this timestamp (another worker was faster)
+    returns False if the job was skipped
+    """
+    if not_before is not None:
+        last = status(name).get('last_run')
+        if last and last >= not_before.isoformat(timespec='seconds'):
+            return False
+    token = _acquire(name)
+    if token is None:
+        return False
+
+    started = datetime.now()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        func()
+    except Exception as e:
+        error = str(e)
+        print(f'Scheduled job {name} failed:', e)
+    finally:
+        _finish(name, token, started.isoformat(timespec='seconds'), round(time.perf_counter() - t0, 3), error)
+    return True
+
+def status(name='automations'):
+    """{'last_run', 'last_duration', 'last_error', 'running'} of a job, empty dict if it never ran"""
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT last_run, last_duration, last_error, owner, lease_until FROM scheduler_state WHERE name = ?', (name,))
+        row = cur.fetchone()
+    if not row:
+        return {}
+    return {
+        'last_run': row['last_run'],
+        'last_duration': row['last_duration'],
+        'last_error': row['last_error'],
+        'running': row['owner'] is not None and (row['lease_until'] or 0) > time.time(),
+    }
+
+# -------------------------
+# database maintenance
+# -------------------------
+def run_optimize(not_before=None):
+    """planner statistics, after the automations added their rows"""
+    return run_job('optimize', dbmod.optimize, not_before)
+
+# -------------------------
+# automations
+# -------------------------
+def run_automations(not_before=None):
+    return run_job('automations', auto_mod.update_fix_transactions, not_before)
+
+def next_run(now=None):
+    """next datetime the daily run is due"""
+    now = now or datetime.now()
+    try:
+        hour, minute = (int(x) for x in RUN_AT.split(':'))
+    except ValueError:
+        hour, minute = 3, 0
+    due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return due if due > now else due + timedelta(days=1)
+
+def _safe(run, *args):
+    """run(*args), None if it raised: a locked database must not end the scheduler thread"""
+    try:
+        return run(*args)
+    except Exception as e:
+        print('Scheduler run failed:', e)
+        return None
+
+def _loop():
+    # first pass right away, like the old run at startup.
+    # wanted: a run is owed (startup or trigger()). it is skipped while another worker holds
+    # the lease, whose run may have started before the edit, so it is retried until it ran
+    wanted = not _safe(run_automations)
+    _safe(run_optimize)
+    while True:
+        due = next_run()
+        timeout = max(1.0, (due - datetime.now()).total_seconds())
+        if wanted:
+            timeout = min(timeout, RETRY_SECONDS)
+        triggered = _wake.wait(timeout=timeout)
+        _wake.clear()
+        if triggered or wanted:
+            wanted = not _safe(run_automations)
+        if not triggered and datetime.now() >= due:
+            # skipped cheaply (not_before) if the run above or another worker already covered it
+            wanted = _safe(run_automations, due) is None or wanted
+            _safe(run_optimize, due)
+
+def start():
+    """start the scheduler thread of this process (once)"""
+    global _thread
+    with _thread_lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_loop, name='automations-scheduler', daemon=True)
+        _thread.start()
+
+def trigger():
+    """ask the scheduler thread to run the automations now, e.g. after an edit"""
+    _wake.set()
@@ -0,0 +1,100 @@
+import re
+import sqlite3
+
+from backend import db as dbmod
+
+# -------------------------
+# database
+# -------------------------
+# external content fts5 index over expenses.description, the text itself stays
+# in expenses and triggers keep the index in sync
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(
+    description,
+    content='expenses',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+"""
+
+TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS trg_expenses_fts_insert AFTER INSERT ON expenses
+BEGIN
+    INSERT INTO expenses_fts (rowid, description) VALUES (NEW.id, NEW.description);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_expenses_fts_delete AFTER DELETE ON expenses
+BEGIN
+    INSERT INTO expenses_fts (expenses_fts, rowid, description) VALUES ('delete', OLD.id, OLD.description);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_expenses_fts_update AFTER UPDATE OF description ON expenses
+BEGIN
+    INSERT INTO expenses_fts (expenses_fts, rowid, description) VALUES ('delete', OLD.id, OLD.description);
+    INSERT INTO expenses_fts (rowid, description) VALUES (NEW.id, NEW.description);
+END;
+"""
+
+_fts_ok = None  # None = not checked yet
+
+def init_search_db():
+    """
+    create the fts index + triggers and fill it on first run.
+    returns False (and searches fall back to LIKE) if sqlite has no fts5
+    """
+    global _fts_ok
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'expenses_fts'")
+        existed = cur.fetchone() is not None
+        try:
+            cur.executescript(SCHEMA + TRIGGERS)
+        except sqlite3.OperationalError as e:
+            print('Full-text search not available, using LIKE:', e)
+            _fts_ok = False
+            return False
+        if not existed:
+            cur.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+        conn.commit()
+    _fts_ok = True
+    return True
+
+def rebuild_search_index():
+    with dbmod.get_conn() as conn:
+        conn.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+        conn.commit()
+
+def fts_available():
+    global _fts_ok
+    if _fts_ok is None:
+        with dbmod.get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'expenses_fts'")
+            _fts_ok = cur.fetchone() is not None
+    return _fts_ok
+
+# -------------------------
+# query helpers
+# -------------------------
+def match_query(text):
+    """
+    user input -> fts5 MATCH expression: every word must appear, each as a prefix.
+    'rew sup' -> '"rew"* "sup"*'. returns None if there is no word to search for
+    """
+    tokens = re.findall(r'\w+', text or '')
+    if not tokens:
+        return None
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+def description_filter(text):
+    """
+    (' AND ...', params) restricting expenses to descriptions matching `text`.
+    uses the fts index when possible, otherwise a substring LIKE
+    """
+    match = match_query(text) if fts_available() else None
+    if match is None:
+        return ' AND description LIKE ?', [f'%{text}%']
+    return ' AND id IN (SELECT rowid FROM expenses_fts WHERE expenses_fts MATCH ?)', [match]
+
+def relevance_match(text):
+    """MATCH expression to rank the index page by, or None when ranking isn't possible"""
+    return match_query(text) if fts_available() else None
@@ -1,25 +1,126 @@
-import uuid
-import threading
-import time
+import json
 import os
+import socket
 import subprocess
-from datetime import datetime
+import threading
+import time
+import uuid
 from pathlib import Path
 
+from backend import db as dbmod
+
 JOBS_DIR = Path('data/sync_jobs')
-JOBS_DIR.mkdir(parents=True, exist_ok=True)
+# the registry lives next to the logs, not in the main db: that file is what the
+# download sync replaces and the upload sync copies
+JOBS_DB_PATH = str(JOBS_DIR / 'jobs.db')
+# sync scripts running at the same time, over all worker processes
+MAX_RUNNING = int(os.environ.get('SYNC_MAX_RUNNING', '1'))
+# finished jobs (and their logs) kept, older ones are evicted
+KEEP_JOBS = int(os.environ.get('SYNC_KEEP_JOBS', '50'))
+KEEP_DAYS = int(os.environ.get('SYNC_KEEP_DAYS', '30'))
+# a running job's worker writes a heartbeat this often; a job without one for
+# STALE_AFTER seconds lost its worker (process killed) and is marked failed
+HEARTBEAT_SECONDS = 10
+STALE_AFTER = 6 * HEARTBEAT_SECONDS
+
+# -------------------------
+# database
+# -------------------------
+# one row per job. state: queued -> running -> done | failed.
+# merged counts the requests that were folded into a job while it was queued
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_jobs (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT NOT NULL UNIQUE,
+    script TEXT NOT NULL,
+    argv TEXT NOT NULL DEFAULT '[]',
+    env TEXT,
+    state TEXT NOT NULL,
+    merged INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    started_at TEXT,
+    finished_at TEXT,
+    owner TEXT,
+    heartbeat REAL,
+    pid INTEGER,
+    returncode INTEGER,
+    error TEXT,
+    log_path TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_sync_jobs_state ON sync_jobs(state, script);
+"""
+
+_owner = f'{socket.gethostname()}:{os.getpid()}'
+_db_ready = False
+_workers = 0         # worker threads of this process
+_wakeups = 0         # jobs submitted since a worker last looked for work
+_workers_lock = threading.Lock()
+
+def init_sync_db():
+    global _db_ready
+    with dbmod.get_conn(JOBS_DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.executescript(SCHEMA)
+        conn.commit()
+    _db_ready = True
+    prune()
+
+def _ensure_db():
+    if not _db_ready:
+        init_sync_db()
+
+def _now():
+    return time.strftime('%Y-%m-%d %H:%M:%S')
 
-os.makedirs('scripts', exist_ok=True)
+def _log_path(job_id):
+    # created on first use, not at import
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    return str(JOBS_DIR / f'{job_id}.log')
 
-_jobs = {}  # job_id -> dict with pid, started_at, running, returncode, log_path, error
+def _job_dict(row):
+    job = dict(row)
+    job['argv'] = json.loads(job['argv'] or '[]')
+    job['env'] = json.loads(job['env']) if job['env'] else None
+    # queued jobs count as running for the status poll, they haven't finished
+    job['running'] = job['state'] in ('queued', 'running')
+    return job
 
+def _set(job_id, **fields):
+    cols = ', '.join(f'{k} = ?' for k in fields)
+    with dbmod.get_conn(JOBS_DB_PATH) as conn:
+        conn.execute(f'UPDATE sync_jobs SET {cols} WHERE job_id = ?', list(fields.values()) + [job_id])
+        conn.commit()
+
+def prune():
+    """evict finished jobs beyond KEEP_JOBS or older than KEEP_DAYS, with their logs"""
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - KEEP_DAYS * 86400))
+    with dbmod.get_conn(JOBS_DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT job_id, log_path FROM sync_jobs
+            WHERE state IN ('done', 'failed')
+              AND (created_at < ? OR id NOT IN (
+                  SELECT id FROM sync_jobs WHERE state IN ('done', 'failed') ORDER BY id DESC LIMIT ?))
+        """, (cutoff, KEEP_JOBS))
+        old = cur.fetchall()
+        cur.executemany('DELETE FROM sync_jobs WHERE job_id = ?', [(r['job_id'],) for r in old])
+        conn.commit()
+    for r in old:
+        if r['log_path']:
+            try:
+                os.remove(r['log_path'])
+            except OSError:
+                pass
+    return len(old)
+
+# -------------------------
+# running a job
+# -------------------------
 def _run_process_and_stream(cmd_argv, log_path, job_id, env=None):
-    """Run process, redirect stdout/stderr to log file, update _jobs metadata."""
-    _jobs[job_id]['running'] = True
-    _jobs[job_id]['started_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    """Run process, redirect stdout/stderr to log file, record the outcome in the registry."""
     try:
         with open(log_path, 'a', encoding='utf-8', errors='ignore') as logf:
-            logf.write(f'Running: {' '.join(cmd_argv)}\n\n')
+            logf.write('Running: ' + ' '.join(cmd_argv) + '\n\n')
             logf.flush()
 
             # start process and let the OS write stdout/stderr directly to the file
@@ -32,27 +133,106 @@ def _run_process_and_stream(cmd_argv, log_path, job_id, env=None):
                 env=env,
                 close_fds=True
             )
+            _set(job_id, pid=proc.pid, heartbeat=time.time())
 
-            _jobs[job_id]['pid'] = proc.pid
-
-            # wait for completion (blocking inside the worker thread)
-            proc.wait()
+            # wait for completion, telling other workers this job is still alive
+            while True:
+                try:
+                    proc.wait(timeout=HEARTBEAT_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    _set(job_id, heartbeat=time.time())
 
-            _jobs[job_id]['returncode'] = proc.returncode
-            _jobs[job_id]['running'] = False
+            # the log is complete before the state says so: a follower stops reading once it sees the state
             logf.write(f'\nProcess finished with returncode={proc.returncode}\n')
             logf.flush()
+            _set(job_id, state='done' if proc.returncode == 0 else 'failed', returncode=proc.returncode, finished_at=_now())
     except Exception as e:
-        _jobs[job_id]['running'] = False
-        _jobs[job_id]['error'] = str(e)
         with open(log_path, 'a', encoding='utf-8', errors='ignore') as logf:
             logf.write(f'\nException: {e}\n')
+        _set(job_id, state='failed', error=str(e), finished_at=_now())
 
+def _execute(job):
+    cmd = ['/bin/bash', job['script']] + job['argv']
+    # upload scripts copy the db file, so the WAL is folded in right before they run
+    # (a queued job may start a while after it was requested)
+    dbmod.checkpoint()
+    _run_process_and_stream(cmd, job['log_path'], job['job_id'], job['env'])
+
+def _claim():
+    """
+    take the oldest queued job if fewer than MAX_RUNNING jobs run (in any process).
+    one conditional UPDATE, so two workers can't take the same job or exceed the limit
+    """
+    token = f'{_owner}:{uuid.uuid4().hex}'
+    now = time.time()
+    with dbmod.get_conn(JOBS_DB_PATH) as conn:
+        cur = conn.cursor()
+        # jobs whose worker stopped sending heartbeats don't hold a slot forever
+        cur.execute("""
+            UPDATE sync_jobs SET state = 'failed', error = 'worker lost', finished_at = ?
+            WHERE state = 'running' AND IFNULL(heartbeat, 0) < ?
+        """, (_now(), now - STALE_AFTER))
+        cur.execute("""
+            UPDATE sync_jobs SET state = 'running', owner = ?, started_at = ?, heartbeat = ?
+            WHERE id = (SELECT id FROM sync_jobs WHERE state = 'queued' ORDER BY id LIMIT 1)
+              AND (SELECT COUNT(*) FROM sync_jobs WHERE state = 'running') < ?
+        """, (token, _now(), now, MAX_RUNNING))
+        conn.commit()
+        if cur.rowcount != 1:
+            return None
+        cur.execute("SELECT * FROM sync_jobs WHERE owner = ? AND state = 'running'", (token,))
+        row = cur.fetchone()
+    return _job_dict(row) if row else None
+
+def _worker():
+    global _workers, _wakeups
+    try:
+        while True:
+            job = _claim()
+            if job is not None:
+                try:
+                    _execute(job)
+                except Exception as e:
+                    _set(job['job_id'], state='failed', error=str(e), finished_at=_now())
+                prune()
+                continue
+            with _workers_lock:
+                # a job submitted while this worker was claiming: look once more
+                if _wakeups:
+                    _wakeups = 0
+                    continue
+                _workers -= 1
+                return
+    except Exception as e:
+        # e.g. the registry stayed locked: give the slot back, the next submit starts a worker.
+        # a job claimed but not finished is failed by the stale heartbeat check in _claim()
+        print('Sync worker stopped:', e)
+        with _workers_lock:
+            _workers -= 1
+
+def _wake_worker():
+    """
+    make sure a worker of this process looks at the queue. at most MAX_RUNNING threads;
+    a job that can't start now is taken by whichever worker (in any process) finishes next
+    """
+    global _workers, _wakeups
+    with _workers_lock:
+        _wakeups += 1
+        if _workers >= MAX_RUNNING:
+            return
+        _workers += 1
+    # not a daemon, so a running upload finishes even when the server shuts down
+    threading.Thread(target=_worker, name='sync-worker', daemon=False).start()
 
+# -------------------------
+# public api
+# -------------------------
 def start_sync_job(script_path, argv=None, env=None):
     """
-    Start a background job that runs 'script_path' with optional argv list.
-    Returns job_id and metadata. Note: pid may be None for a short moment until the thread starts.
+    queue a job that runs 'script_path' with optional argv list, returns the job metadata.
+    if the same script (and argv / env) is already waiting, no new job is made: the request
+    is merged into the waiting one (whose run will see the newest data anyway), merged=True
     """
     if argv is None:
         argv = []
@@ -62,58 +242,137 @@ def start_sync_job(script_path, argv=None, env=None):
     if not Path(script_abspath).exists():
         raise FileNotFoundError(f'{script_abspath} not found')
 
-    job_id = uuid.uuid4().hex
-    log_path = str(JOBS_DIR / f'{job_id}.log')
-
-    # run the script via bash
-    cmd = ['/bin/bash', script_abspath] + argv
+    _ensure_db()
+    argv_json = json.dumps(argv)
+    env_json = json.dumps(env, sort_keys=True) if env is not None else None
+    with dbmod.get_conn(JOBS_DB_PATH) as conn:
+        cur = conn.cursor()
+        # the UPDATE takes the write lock, so the job can't be claimed between it and the SELECT
+        cur.execute("""
+            UPDATE sync_jobs SET merged = merged + 1
+            WHERE id = (SELECT id FROM sync_jobs WHERE state = 'queued' AND script = ? AND argv = ? AND env IS ? ORDER BY id LIMIT 1)
+        """, (script_abspath, argv_json, env_json))
+        merged = cur.rowcount == 1
+        if merged:
+            cur.execute("SELECT * FROM sync_jobs WHERE state = 'queued' AND script = ? AND argv = ? AND env IS ? ORDER BY id LIMIT 1",
+                        (script_abspath, argv_json, env_json))
+            row = cur.fetchone()
+        else:
+            job_id = uuid.uuid4().hex
+            cur.execute("""
+                INSERT INTO sync_jobs (job_id, script, argv, env, state, created_at, log_path)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?)
+            """, (job_id, script_abspath, argv_json, env_json, _now(), _log_path(job_id)))
+            cur.execute('SELECT * FROM sync_jobs WHERE job_id = ?', (job_id,))
+            row = cur.fetchone()
+        conn.commit()
 
-    _jobs[job_id] = {
-        'job_id': job_id,
-        'pid': None,
-        'started_at': None,
-        'running': True,
-        'returncode': None,
-        'log_path': log_path,
-        'error': None
-    }
+    _wake_worker()
+    job = _job_dict(row)
+    job['merged'] = merged
+    return job
 
-    # start non-daemon worker thread, so it runs to completion
-    t = threading.Thread(target=_run_process_and_stream, args=(cmd, log_path, job_id, env))
-    t.daemon = False
-    t.start()
+def get_job(job_id):
+    """job metadata from the registry (any worker process), None if unknown or evicted"""
+    _ensure_db()
+    with dbmod.get_conn(JOBS_DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT * FROM sync_jobs WHERE job_id = ?', (job_id,))
+        row = cur.fetchone()
+    return _job_dict(row) if row else None
 
-    # return a shallow copy, caller can query get_job(job_id) to see updates
-    return _jobs[job_id].copy()
+def _complete_utf8(data):
+    """cut a partial utf-8 character off the end, it is sent with the next read"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 != 0x80:  # first byte of a character
+            need = 1 if byte < 0x80 else 2 if byte >= 0xC0 and byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return data if need <= back else data[:-back]
+    return data
 
-def get_job(job_id):
-    return _jobs.get(job_id)
+def _read_from(path, offset, max_bytes):
+    """(bytes read, offset of the next unread byte, file size)"""
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if offset > size:
+                offset = 0  # a different (new) file than the one the offset was for
+            f.seek(offset)
+            data = _complete_utf8(f.read(max_bytes))
+    except FileNotFoundError:
+        return b'', 0, 0
+    return data, offset + len(data), size
 
-def tail_log(job_id, max_bytes=32_000):
-    meta = _jobs.get(job_id)
+def read_log(job_id, offset=None, max_bytes=32_000):
+    """
+    log output of a job. without an offset: the last max_bytes (the old tail),
+    with one: only the bytes after it. 'offset' in the result is where the next
+    read continues, 'done' is set once the job finished and everything was read
+    """
+    meta = get_job(job_id)
     if not meta:
         return None
-    p = Path(meta['log_path'])
-    if not p.exists():
-        return {'ok': True, 'log': ''}
+    if offset is None:
+        size = os.path.getsize(meta['log_path']) if os.path.exists(meta['log_path']) else 0
+        offset = max(0, size - max_bytes)
+        truncated = offset > 0
+    else:
+        truncated = False
+    data, next_offset, size = _read_from(meta['log_path'], offset, max_bytes)
+    res = {
+        'ok': True,
+        'log': data.decode('utf-8', errors='ignore'),
+        'offset': next_offset,
+        'state': meta['state'],
+        'returncode': meta['returncode'],
+        'done': not meta['running'] and next_offset >= size,
+    }
+    if truncated:
+        res['truncated'] = True
+    return res
 
-    try:
-        filesize = p.stat().st_size
-        with p.open('rb') as f:
-            if filesize > max_bytes:
-                f.seek(filesize - max_bytes)
-            data = f.read().decode('utf-8', errors='ignore')
-    except Exception:
-        data = p.read_text(encoding='utf-8', errors='ignore')
-
-    if len(data) > max_bytes:
-        return {'ok': True, 'log': data[-max_bytes:], 'truncated': True}
-    return {'ok': True, 'log': data}
+def tail_log(job_id, max_bytes=32_000):
+    return read_log(job_id, None, max_bytes)
+
+def follow_log(job_id, offset=0, interval=0.5, max_seconds=300):
+    """
+    generator of ('log', text, next offset) while the job writes its log and a final
+    ('done', job, offset). between reads only the file size is checked; the
+    registry is asked for the job state when nothing new arrived. stops after
+    max_seconds (clients reconnect with their last offset)
+    """
+    deadline = time.monotonic() + max_seconds
+    meta = get_job(job_id)
+    if not meta:
+        return
+    path = meta['log_path']
+    while True:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if size > offset:
+            data, offset, _ = _read_from(path, offset, 64_000)
+            if data:
+                yield 'log', data.decode('utf-8', errors='ignore'), offset
+                continue
+        meta = get_job(job_id)
+        if meta is None or not meta['running']:
+            # the final lines can land between the size check and the state check
+            data, offset, _ = _read_from(path, offset, 1 << 30)
+            if data:
+                yield 'log', data.decode('utf-8', errors='ignore'), offset
+            yield 'done', meta, offset
+            return
+        if time.monotonic() > deadline:
+            return
+        time.sleep(interval)
 
 def run_sync_job(script_path, argv=None, env=None):
     """
     run 'script_path' synchronously (blocking)
-    waits until the process completes before returning
+    waits until the process completes before returning.
+    recorded in the registry, but not queued: startup needs the download right away
     """
     if argv is None:
         argv = []
@@ -127,28 +386,24 @@ def run_sync_job(script_path, argv=None, env=None):
         print('No path set for SYNC_DOWNLOAD_SCRIPT. Using local database version.')
         return
 
+    _ensure_db()
     job_id = uuid.uuid4().hex
-    log_path = str(JOBS_DIR / f'{job_id}.log')
+    log_path = _log_path(job_id)
 
     cmd = ['/bin/bash', script_abspath] + argv
 
-    _jobs[job_id] = {
-        'job_id': job_id,
-        'pid': None,
-        'started_at': datetime.utcnow().isoformat(),
-        'running': True,
-        'returncode': None,
-        'log_path': log_path,
-        'error': None,
-    }
+    with dbmod.get_conn(JOBS_DB_PATH) as conn:
+        conn.execute("""
+            INSERT INTO sync_jobs (job_id, script, argv, state, created_at, started_at, owner, heartbeat, log_path)
+            VALUES (?, ?, ?, 'running', ?, ?, ?, ?, ?)
+        """, (job_id, script_abspath, json.dumps(argv), _now(), _now(), _owner, time.time(), log_path))
+        conn.commit()
 
     try:
         # call the process runner directly (not in a thread)
         _run_process_and_stream(cmd, log_path, job_id, env)
     except Exception as e:
         print(f'SYNC_DOWNLOAD_SCRIPT had an error while being executed: {str(e)}')
-        _jobs[job_id]['error'] = str(e)
-        _jobs[job_id]['running'] = False
-        _jobs[job_id]['returncode'] = -1
+        _set(job_id, state='failed', error=str(e), returncode=-1, finished_at=_now())
 
-    return _jobs[job_id].copy()
+    return get_job(job_id)
@@ -1,16 +1,130 @@
+import os
 import re
+import json
+import base64
 import calendar
-from datetime import datetime
-from backend.categories import get_categories_dict
-
-def autocategory(description):
-    """if description has an assigned category, the category is returned, else other"""
-    categories_dict = get_categories_dict()
-    for category, keywords in categories_dict.items():
-        if description in keywords:
-            return category
+from collections import deque
+from datetime import datetime, date, timedelta
+from backend.categories import get_categories_dict, categories_version
+
+# opt-in matching modes for autocategory, e.g. AUTOCATEGORY_SUBSTRING=1 in .env
+AUTOCATEGORY_IGNORE_CASE = os.environ.get('AUTOCATEGORY_IGNORE_CASE', '') == '1'
+AUTOCATEGORY_SUBSTRING = os.environ.get('AUTOCATEGORY_SUBSTRING', '') == '1'
+# amount search matches amounts within +- this much of the entered value
+AMOUNT_SEARCH_TOLERANCE = float(os.environ.get('AMOUNT_SEARCH_TOLERANCE', '1'))
+
+_matchers = {}  # (ignore_case, substring) -> (categories version, exact dict, automaton or None)
+
+def _build_automaton(keywords):
+    """
+    aho-corasick automaton over the keywords: finds them in one pass over a description.
+    per state: goto (char -> state), fail (state of the longest proper suffix that is also
+    a keyword prefix), depth and the length of the longest keyword ending in it
+    """
+    goto, fail, depth, longest = [{}], [0], [0], [0]
+    for kw in keywords:
+        state = 0
+        for ch in kw:
+            nxt = goto[state].get(ch)
+            if nxt is None:
+                nxt = len(goto)
+                goto[state][ch] = nxt
+                goto.append({})
+                fail.append(0)
+                depth.append(depth[state] + 1)
+                longest.append(0)
+            state = nxt
+        longest[state] = max(longest[state], len(kw))
+
+    # breadth first: a fail state is shallower, so it is complete before the states pointing to it
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        longest[state] = max(longest[state], longest[fail[state]])
+        for ch, nxt in goto[state].items():
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            queue.append(nxt)
+    return goto, fail, depth, longest
+
+def _search(automaton, text):
+    """the leftmost keyword in text, the longest one starting there, or None"""
+    goto, fail, depth, longest = automaton
+    state, start, end = 0, -1, -1
+    for i, ch in enumerate(text, 1):
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        n = longest[state]
+        if n and (start < 0 or i - n <= start):
+            start, end = i - n, i
+        elif start >= 0 and i - depth[state] > start:
+            # no keyword starting at or before start can still match
+            break
+    return text[start:end] if start >= 0 else None
+
+def _get_matcher(ignore_case, substring):
+    """
+    keyword lookup structures, built once per categories version:
+    an exact keyword -> category dict and, for substring matching,
+    an aho-corasick automaton over all keywords
+    """
+    key = (ignore_case, substring)
+    version, shareable = categories_version()
+    cached = _matchers.get(key)
+    if cached and cached[0] == version:
+        return cached
+
+    exact = {}
+    for category, keywords in get_categories_dict().items():
+        for kw in keywords:
+            # categories come sorted by name, the first one owning a keyword wins
+            exact.setdefault(kw.casefold() if ignore_case else kw, category)
+
+    automaton = None
+    if substring and any(exact):
+        automaton = _build_automaton(kw for kw in exact if kw)
+
+    cached = (version, exact, automaton)
+    if shareable:
+        _matchers[key] = cached
+    return cached
+
+def _match(matcher, description, ignore_case):
+    _, exact, automaton = matcher
+    key = description.casefold() if ignore_case else description
+    category = exact.get(key)
+    if category is not None:
+        return category
+    if automaton is not None:
+        found = _search(automaton, key)
+        if found is not None:
+            return exact[found]
     return 'other'
 
+def autocategory(description, ignore_case=None, substring=None):
+    """
+    if description has an assigned category, the category is returned, else other.
+    ignore_case / substring default to AUTOCATEGORY_IGNORE_CASE / AUTOCATEGORY_SUBSTRING
+    """
+    return autocategorize_many([description], ignore_case, substring)[0]
+
+def keyword_categorizer(ignore_case=None, substring=None):
+    """
+    autocategorize_many() bound to the keywords as they are now, for callers with many batches.
+    the matcher is looked up once, e.g. before a write transaction in which it can't be cached
+    """
+    ignore_case = AUTOCATEGORY_IGNORE_CASE if ignore_case is None else ignore_case
+    substring = AUTOCATEGORY_SUBSTRING if substring is None else substring
+    matcher = _get_matcher(ignore_case, substring)
+    return lambda descriptions: [_match(matcher, d or '', ignore_case) for d in descriptions]
+
+def autocategorize_many(descriptions, ignore_case=None, substring=None):
+    """autocategory() for a batch of descriptions, the matcher is looked up once"""
+    return keyword_categorizer(ignore_case, substring)(descriptions)
+
 def parse_date(date_obj, stri=True):
     if date_obj == '':
         date_obj = datetime.now()
@@ -33,24 +147,90 @@ def validate_form_date(date_str):
     date_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}$')
     return date_pattern.match(date_str)
 
+def get_date_range(year=None, month=None, day=None, total=False):
+    """
+    return the half-open range (start, end) as 'YYYY-MM-DD' strings for the
+    day / month / year view, or (None, None) when no time filter applies.
+    `date >= start AND date < end` can use idx_expenses_date, strftime() can't
+    """
+    if total or (year is None and month is None and day is None):
+        return None, None
+    if year is None:
+        year = datetime.now().year
+
+    if month is None:
+        return f'{year:04}-01-01', f'{year + 1:04}-01-01'
+    if day is None:
+        if month == 12:
+            return f'{year:04}-12-01', f'{year + 1:04}-01-01'
+        return f'{year:04}-{month:02}-01', f'{year:04}-{month + 1:02}-01'
+    try:
+        start = date(year, month, day)
+    except ValueError:
+        # impossible date (e.g. 2025-02-31): empty range, nothing matches
+        return f'{year:04}-{month:02}-{day:02}', f'{year:04}-{month:02}-{day:02}'
+    return start.isoformat(), (start + timedelta(days=1)).isoformat()
+
 def get_where_clause(where_clause, year=None, month=None, day=None, total=False):
+    """
+    append the time filter to where_clause.
+    returns (where_clause, params, duration), params are bound to the range placeholders
+    """
     duration = ''
+    params = []
 
     if day is not None:
-        where_clause += f"AND strftime('%d', date) = '{day:02}'"
         duration = str(day) + ' '
     if month is not None:
-        where_clause += f"AND strftime('%m', date) = '{month:02}'"
         duration += calendar.month_name[month] + ' '
     if year is not None:
-        where_clause += f"AND strftime('%Y', date) = '{year}'"
         duration += str(year)
     else:
         duration += str(datetime.now().year)
-            
+
+    if not total:
+        start, end = get_date_range(year, month, day)
+        if start is not None:
+            where_clause += 'AND date >= ? AND date < ? '
+            params.extend([start, end])
+
     duration = 'total duration' if total else duration
 
-    return where_clause, duration
+    return where_clause, params, duration
+
+def amount_filter(value, tolerance=None):
+    """
+    (sql, params) matching expenses and incomes whose amount is within +- tolerance of value.
+    a range on abs_amount_cents, so idx_expenses_abs_amount is used. input that
+    isn't a number matches nothing
+    """
+    tolerance = AMOUNT_SEARCH_TOLERANCE if tolerance is None else tolerance
+    try:
+        value = abs(float(value))
+        low, high = round((value - tolerance) * 100), round((value + tolerance) * 100)
+    except (ValueError, OverflowError):
+        return ' AND 0 = 1', []
+    return ' AND abs_amount_cents BETWEEN ? AND ?', [max(low, 0), high]
+
+def encode_cursor(after):
+    """(order value, id) -> opaque url-safe string for 'next page' links"""
+    raw = json.dumps(list(after), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    """inverse of encode_cursor, returns None for a missing or broken token"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        value, last_id = json.loads(raw)
+        last_id = int(last_id)
+    except Exception:
+        return None
+    # the value is bound as a sql parameter: only what encode_cursor writes
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (str, int, float))):
+        return None
+    return value, last_id
 
 def safe_date(year, month, day):
     """return a valid date. If day > last day of month, use last day of month."""
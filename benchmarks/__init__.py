@@ -0,0 +1,6 @@
+"""
+benchmarks for the expense tracker.
+
+  python -m benchmarks.run --size 100k   routes and backend hot paths on a synthetic ledger
+  python benchmarks/startup.py           import time and time to first request
+"""
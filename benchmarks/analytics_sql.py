@@ -0,0 +1,106 @@
+"""
+the /analytics/data statistics computed in plain sqlite, as the baseline for
+backend.analytics: window functions over a generated calendar for the rolling
+sums, one ordered query per percentile, conditional sums for month-over-month.
+returns the same dict as analytics.compute()
+"""
+import math
+from datetime import date, timedelta
+
+from backend import analytics
+from backend import categories as catmod
+from backend import db as dbmod
+
+def compute(start=None, end=None, today=None):
+    today = today or date.today()
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        if start is None:
+            cur.execute("SELECT MIN(substr(date, 1, 10)), MAX(substr(date, 1, 10)) FROM expenses WHERE is_expense = 1")
+            first, last = cur.fetchone()
+            if first is None:
+                return analytics._empty(start, end)
+            start, end = first, (date.fromisoformat(last) + timedelta(days=1)).isoformat()
+        since = (date.fromisoformat(start) - timedelta(days=analytics.LOOKBACK_DAYS)).isoformat()
+
+        windows = ',\n'.join(
+            f'ROUND(SUM(spend) OVER (ORDER BY day ROWS BETWEEN {w - 1} PRECEDING AND CURRENT ROW), 2) AS spend_{w}d'
+            for w in analytics.WINDOWS)
+        cur.execute(f"""
+            WITH RECURSIVE calendar(day) AS (
+                SELECT ? UNION ALL SELECT date(day, '+1 day') FROM calendar WHERE day < date(?, '-1 day')
+            ),
+            daily AS (
+                SELECT substr(date, 1, 10) AS day, -SUM(amount_cents) / 100.0 AS spend
+                FROM expenses WHERE is_expense = 1 AND date >= ? AND date < ?
+                GROUP BY day
+            ),
+            filled AS (
+                SELECT calendar.day, COALESCE(daily.spend, 0) AS spend
+                FROM calendar LEFT JOIN daily USING (day)
+            ),
+            rolled AS (SELECT day, {windows} FROM filled)
+            SELECT * FROM rolled WHERE day >= ?
+        """, (since, end, since, end, start))
+        rows = cur.fetchall()
+        rolling = {'labels': [r['day'] for r in rows]}
+        for w in analytics.WINDOWS:
+            rolling[f'spend_{w}d'] = [r[f'spend_{w}d'] for r in rows]
+
+        in_range = 'FROM expenses WHERE is_expense = 1 AND date >= ? AND date < ?'
+        cur.execute(f'SELECT COUNT(*), -SUM(amount_cents) / 100.0 {in_range}', (start, end))
+        count, total = cur.fetchone()
+        total = total or 0.0
+
+        # linear interpolation between the two closest ranks, like numpy
+        percentiles = {}
+        for p in analytics.PERCENTILES:
+            if not count:
+                percentiles[f'p{p}'] = 0.0
+                continue
+            rank = p / 100 * (count - 1)
+            lo = math.floor(rank)
+            cur.execute(f'SELECT -amount_cents / 100.0 AS spend {in_range} ORDER BY spend LIMIT 2 OFFSET ?', (start, end, lo))
+            values = [r[0] for r in cur.fetchall()]
+            hi = values[1] if len(values) > 1 else values[0]
+            percentiles[f'p{p}'] = round(values[0] + (hi - values[0]) * (rank - lo), 2)
+
+        stop = date.fromisoformat(end)
+        elapsed = max(1, (min(stop, today + timedelta(days=1)) - date.fromisoformat(start)).days)
+        last_month = (date.fromisoformat(start) + timedelta(days=elapsed - 1)).replace(day=1)
+        prev_month = (last_month - timedelta(days=1)).replace(day=1)
+        month_end = min(stop, (last_month + timedelta(days=31)).replace(day=1))
+        cur.execute(f"""
+            SELECT category_id,
+                   COALESCE(-SUM(CASE WHEN date >= :last THEN amount_cents END), 0) / 100.0 AS current,
+                   COALESCE(-SUM(CASE WHEN date < :last THEN amount_cents END), 0) / 100.0 AS previous
+            FROM expenses
+            WHERE is_expense = 1 AND date >= :prev AND date < :end
+            GROUP BY category_id
+            ORDER BY ABS(current - previous) DESC, category_id
+            LIMIT {analytics.MOM_LIMIT}
+        """, {'last': last_month.isoformat(), 'prev': prev_month.isoformat(), 'end': month_end.isoformat()})
+        names = catmod.category_names()
+        mom = []
+        for r in cur.fetchall():
+            delta = r['current'] - r['previous']
+            mom.append({
+                'category': names.get(r['category_id'], '(none)'),
+                'current': round(r['current'], 2),
+                'previous': round(r['previous'], 2),
+                'delta': round(delta, 2),
+                'pct': round(delta / r['previous'] * 100, 1) if r['previous'] > 0 else None,
+            })
+
+    return {
+        'start': start,
+        'end': end,
+        'days': elapsed,
+        'count': count,
+        'total': round(total, 2),
+        'daily_burn': round(total / elapsed, 2),
+        'percentiles': percentiles,
+        'rolling': rolling,
+        'mom': {'month': last_month.strftime('%Y-%m'), 'previous_month': prev_month.strftime('%Y-%m'), 'categories': mom},
+        'empty': count == 0,
+    }
@@ -0,0 +1,97 @@
+"""
+synthetic ledger generator: categories with keywords, automations and transactions
+spread over several years, written into the current database (dbmod.DB_PATH).
+same seed = same ledger, so runs on different commits are comparable
+"""
+import random
+import time
+from datetime import date, timedelta
+
+from backend import db as dbmod
+
+SIZES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+}
+
+WORDS = [
+    'market', 'bakery', 'coffee', 'fuel', 'pharmacy', 'cinema', 'books', 'hardware', 'garden', 'sports',
+    'train', 'taxi', 'hotel', 'insurance', 'phone', 'internet', 'gym', 'pizza', 'sushi', 'kiosk',
+    'online', 'store', 'shop', 'city', 'central', 'express', 'local', 'north', 'south', 'daily',
+]
+EMOJIS = ['🍔', '🚗', '🏠', '💊', '🎬', '📚', '☕', '🛒', '✈️', '💡', '', '']
+CHUNK = 10_000
+
+def _keyword(rng, used):
+    while True:
+        kw = f'{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.randint(1, 999)}'
+        if kw not in used:
+            used.add(kw)
+            return kw
+
+def generate(rows, categories=300, keywords_per_category=3, automations=40, years=5, seed=42):
+    """
+    fill an initialized, empty database. returns a summary dict with the counts,
+    the generated date range and a few sample values the benchmarks filter on
+    """
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    last_day = date.today()
+    first_day = last_day - timedelta(days=365 * years)
+    span = (last_day - first_day).days
+
+    used = set()
+    cat_rows = [(f'category {i:03d}', rng.choice(EMOJIS) or None) for i in range(categories)]
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.executemany('INSERT INTO categories (name, emoji) VALUES (?, ?)', cat_rows)
+        cur.execute('SELECT id FROM categories ORDER BY id')
+        cat_ids = [r['id'] for r in cur.fetchall()]
+
+        keywords = [(cid, _keyword(rng, used)) for cid in cat_ids for _ in range(keywords_per_category)]
+        cur.executemany('INSERT INTO category_keywords (category_id, keyword) VALUES (?, ?)', keywords)
+
+        cur.executemany("""
+            INSERT INTO automations (day, description, amount, category_id, is_expense, start, end)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(rng.randint(1, 31), f'standing order {i}', round(rng.uniform(5, 1500), 2), rng.choice(cat_ids),
+               1 if rng.random() < 0.8 else 0, (first_day + timedelta(days=rng.randint(0, span // 2))).isoformat(),
+               None if rng.random() < 0.7 else (last_day - timedelta(days=rng.randint(0, span // 2))).isoformat())
+              for i in range(automations)])
+        conn.commit()
+
+        # most descriptions are a keyword (so autocategory has something to find),
+        # the rest free text; amounts are skewed towards small expenses
+        kw_list = [kw for _, kw in keywords]
+        kw_category = {kw: cid for cid, kw in keywords}
+        inserted = 0
+        while inserted < rows:
+            n = min(CHUNK, rows - inserted)
+            batch = []
+            for _ in range(n):
+                day = (first_day + timedelta(days=rng.randint(0, span))).isoformat()
+                is_expense = 1 if rng.random() < 0.9 else 0
+                cents = round(rng.lognormvariate(3, 1.1) * 100)
+                if rng.random() < 0.7:
+                    description = rng.choice(kw_list)
+                    category_id = kw_category[description]
+                else:
+                    description = f'{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.choice(WORDS)}'
+                    category_id = rng.choice(cat_ids) if rng.random() < 0.8 else None
+                batch.append((day, description, -cents if is_expense else cents, category_id, is_expense))
+            cur.executemany('INSERT INTO expenses (date, description, amount_cents, category_id, is_expense) VALUES (?, ?, ?, ?, ?)', batch)
+            conn.commit()
+            inserted += n
+
+    return {
+        'rows': rows,
+        'categories': categories,
+        'keywords': len(keywords),
+        'automations': automations,
+        'first_day': first_day.isoformat(),
+        'last_day': last_day.isoformat(),
+        'sample_keyword': kw_list[0],
+        'sample_category': cat_rows[0][0],
+        'seconds': round(time.perf_counter() - started, 3),
+    }
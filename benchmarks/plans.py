@@ -0,0 +1,153 @@
+"""
+query plan check for the main query shapes.
+
+the real routes run against a synthetic ledger, the sql they send to sqlite is
+captured and each shape's EXPLAIN QUERY PLAN must use the expected index and
+never scan the expenses table. exits with 1 on a mismatch, so an index or query
+change that loses a plan is noticed.
+
+usage:
+  python -m benchmarks.plans
+  python -m benchmarks.plans --rows 50000
+"""
+import argparse
+import datetime
+import os
+import re
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, url or callable, statement containing, plan must contain)
+CASES = [
+    ('time filter, month range', 'month_range', 'FROM expenses WHERE 1=1 AND date >=', 'INDEX idx_expenses_date (date>? AND date<?)'),
+    ('index list, month', '/?time={month}', 'FROM expenses_view', 'USING INDEX idx_expenses_date (date>? AND date<?)'),
+    ('index totals, month', '/?time={month}', 'SUM(amount_cents) as total', 'COVERING INDEX idx_expenses_date_cover'),
+    ('index totals, category', '/?time=all&search_cate={category}', 'SUM(amount_cents) as total', 'COVERING INDEX idx_expenses_category_cover'),
+    ('index totals, amount', '/?time=all&search_amount=20', 'SUM(amount_cents) as total', 'INDEX idx_expenses_abs_amount '),
+    ('index list, order by amount', '/?time=all&order=amount', 'FROM expenses_view', 'INDEX idx_expenses_amount_cents'),
+    ('dashboard days, month + category', '/dashboard/data?time={month}&search_cate={category}',
+     "strftime('%Y-%m-%d', date)", 'COVERING INDEX idx_expenses_category_cover'),
+    ('dashboard categories, month + category', '/dashboard/data?time={month}&search_cate={category}',
+     'GROUP BY category_id', 'COVERING INDEX idx_expenses_category_cover'),
+    ('dashboard months, amount', '/dashboard/data?time=all&search_amount=20',
+     "strftime('%Y-%m', date)", 'INDEX idx_expenses_abs_amount '),
+    ('analytics ledger, year', '/analytics/data?time={year}', 'SELECT date, amount_cents, category_id', 'COVERING INDEX idx_expenses_date_cover'),
+    ('automation duplicate check', 'adopt_legacy_rows', 'UPDATE OR IGNORE expenses', 'idx_expenses_category_cover (category_id=? AND date=?)'),
+]
+
+# a plain table scan, 'SCAN e USING INDEX ...' (ordered index walk) is fine
+FULL_SCAN = re.compile(r'^SCAN (expenses|e)$')
+
+def _adopt_legacy_rows(ledger):
+    from backend import automations as auto_mod
+    from backend import db as dbmod
+    day = datetime.date.fromisoformat(ledger['last_day'])
+    with dbmod.get_conn() as conn:
+        auto_mod._adopt_legacy_rows(conn.cursor(), 1, [day, day - datetime.timedelta(days=30)], 1, ledger['sample_keyword'])
+        conn.rollback()
+
+def _month_range(ledger):
+    """the time filter on its own, december too: its range ends in the next year"""
+    from backend import db as dbmod
+    from backend import utils
+    year = int(ledger['last_day'][:4]) - 1
+    with dbmod.get_conn() as conn:
+        for month in (12, 6):
+            where, params, _ = utils.get_where_clause('WHERE 1=1 ', year, month)
+            conn.execute(f'SELECT COUNT(*) FROM expenses {where}', params).fetchone()
+
+# targets that are backend calls instead of urls
+HELPERS = {
+    'adopt_legacy_rows': _adopt_legacy_rows,
+    'month_range': _month_range,
+}
+
+def _captured(client, target, ledger):
+    """statements run by the url / helper, with their parameters inlined"""
+    from backend import db as dbmod
+    statements = []
+    with dbmod.get_conn() as conn:
+        # nested get_conn calls in this thread (the whole request) share this connection
+        conn.set_trace_callback(statements.append)
+        try:
+            if target in HELPERS:
+                HELPERS[target](ledger)
+            else:
+                r = client.get(target)
+                if r.status_code != 200:
+                    raise RuntimeError(f'{target} -> {r.status_code}')
+        finally:
+            conn.set_trace_callback(None)
+    return statements
+
+def _plan(sql):
+    from backend import db as dbmod
+    with dbmod.get_conn() as conn:
+        return [r[3] for r in conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()]
+
+def check(client, ledger, verbose=False):
+    """run all cases, returns the number of failures"""
+    values = {
+        'month': ledger['last_day'][:7],
+        'year': ledger['last_day'][:4],
+        'category': ledger['sample_category'],
+    }
+    failures = 0
+    captured = {}  # each url runs once: a second request would be answered from the dashboard cache
+    for name, target, contains, expected in CASES:
+        target = target.format(**values)
+        if target not in captured:
+            captured[target] = _captured(client, target, ledger)
+        statements = [s for s in captured[target] if contains in s]
+        if not statements:
+            print(f'FAIL {name}: no statement containing {contains!r}')
+            failures += 1
+            continue
+        plan = _plan(statements[0])
+        problems = []
+        if not any(expected in line for line in plan):
+            problems.append(f'expected {expected!r}')
+        if any(FULL_SCAN.match(line) for line in plan):
+            problems.append('full table scan')
+        print(f"{'FAIL' if problems else 'ok  '} {name}" + (': ' + ', '.join(problems) if problems else ''))
+        if problems or verbose:
+            print('     ' + ' '.join(statements[0].split())[:300])
+            for line in plan:
+                print('       ' + line)
+        failures += bool(problems)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--verbose', action='store_true', help='print every plan, not only failing ones')
+    args = parser.parse_args()
+
+    from benchmarks.ledger import generate
+    os.environ.pop('SYNC_DOWNLOAD_SCRIPT', None)
+    os.environ.setdefault('FLASK_SECRET', 'plans')
+
+    with tempfile.TemporaryDirectory(prefix='expense-plans-') as tmp:
+        os.chdir(tmp)
+        sys.path.insert(0, ROOT)
+        import app as appmod
+        from backend import db as dbmod
+
+        appmod._init_database()
+        ledger = generate(args.rows)
+        flask_app = appmod.create_app({'START_SCHEDULER': False})
+        appmod.wait_until_ready()
+        # plans as they are after the scheduler's maintenance run
+        dbmod.optimize()
+        failures = check(flask_app.test_client(), ledger, args.verbose)
+
+        dbmod.close_all_conns()
+        os.chdir(ROOT)
+
+    print(f'{len(CASES) - failures}/{len(CASES)} query shapes use their index')
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
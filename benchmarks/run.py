@@ -0,0 +1,241 @@
+"""
+time the routes and backend hot paths on a synthetic ledger.
+
+the ledger is generated into a temporary directory (the real data/ folder is never
+touched), exchange rates come from a local stub server. results are printed
+(or written with --out) as json, so runs on different commits can be compared.
+
+usage:
+  python -m benchmarks.run --size 100k
+  python -m benchmarks.run --rows 20000 --repeat 3 --only dashboard --out bench.json
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _commit():
+    try:
+        out = subprocess.run(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+class Bench:
+    def __init__(self, repeat, only=None):
+        self.repeat = repeat
+        self.only = only
+        self.results = []
+
+    def run(self, name, func, setup=None, repeat=None):
+        """time func() `repeat` times (setup() before each run is not timed), in ms"""
+        if self.only and self.only not in name:
+            return
+        times = []
+        for _ in range(repeat or self.repeat):
+            if setup:
+                setup()
+            t0 = time.perf_counter()
+            func()
+            times.append((time.perf_counter() - t0) * 1000)
+        result = {
+            'name': name,
+            'runs': len(times),
+            'min_ms': round(min(times), 3),
+            'median_ms': round(statistics.median(times), 3),
+            'mean_ms': round(statistics.mean(times), 3),
+        }
+        self.results.append(result)
+        print(f"{name:<55} median {result['median_ms']:>10.2f} ms", file=sys.stderr)
+
+def _get(client, url):
+    def call():
+        r = client.get(url)
+        if r.status_code != 200:
+            raise RuntimeError(f'{url} -> {r.status_code}')
+    return call
+
+def route_cases(bench, client, ledger):
+    month = ledger['last_day'][:7]
+    year = ledger['last_day'][:4]
+    day = ledger['last_day']
+    kw = ledger['sample_keyword'].split()[0]
+    cat = ledger['sample_category']
+
+    filters = {
+        'month (default)': '',
+        'day': f'time={day}',
+        'year': f'time={year}',
+        'all': 'time=all',
+        'search_desc': f'time=all&search_desc={kw}',
+        'search_cate': f'time=all&search_cate={cat}',
+        'search_amount': 'time=all&search_amount=20',
+        'search_id': 'time=all&search_id=1',
+    }
+    for label, qs in filters.items():
+        bench.run(f'GET / {label}', _get(client, f'/?{qs}'))
+    for order in ('amount', 'category', 'description', 'id'):
+        bench.run(f'GET / all order={order}', _get(client, f'/?time=all&order={order}'))
+    bench.run('GET / search_desc order=relevance', _get(client, f'/?time=all&search_desc={kw}&order=relevance'))
+
+    # the result cache would answer every run after the first one, these time the queries
+    import app as appmod
+    uncached = appmod.dashboard_cache.invalidate
+    views = {'day': f'time={day}', 'month': f'time={month}', 'year': f'time={year}', 'all': 'time=all'}
+    for label, qs in views.items():
+        bench.run(f'GET /dashboard/data {label}', _get(client, f'/dashboard/data?{qs}'), setup=uncached)
+    bench.run('GET /dashboard/data all search_desc', _get(client, f'/dashboard/data?time=all&search_desc={kw}'), setup=uncached)
+    bench.run('GET /dashboard/data month (cached)', _get(client, f'/dashboard/data?time={month}'))
+    bench.run('GET /export all csv', _get(client, '/export?time=all&format=csv'), repeat=1)
+    bench.run('GET /categories', _get(client, '/categories'))
+    bench.run('GET /automations', _get(client, '/automations'))
+
+def backend_cases(bench, ledger):
+    from backend import db as dbmod
+    from backend import categories as catmod
+    from backend import automations as auto_mod
+    from backend import utils
+
+    def reset_watermarks():
+        with dbmod.get_conn() as conn:
+            conn.execute('UPDATE automations SET generated_until = NULL')
+            conn.commit()
+    bench.run('update_fix_transactions full', auto_mod.update_fix_transactions, setup=reset_watermarks)
+    bench.run('update_fix_transactions incremental', auto_mod.update_fix_transactions)
+
+    with dbmod.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT description FROM expenses ORDER BY id LIMIT 10000')
+        descriptions = [r['description'] for r in cur.fetchall()]
+    bench.run('autocategorize_many 10k cold', lambda: utils.autocategorize_many(descriptions), setup=catmod.invalidate_categories)
+    bench.run('autocategorize_many 10k warm', lambda: utils.autocategorize_many(descriptions))
+    bench.run('autocategory x1000', lambda: [utils.autocategory(d) for d in descriptions[:1000]])
+    bench.run('autocategorize_many 10k substring+ignore_case',
+              lambda: utils.autocategorize_many(descriptions, ignore_case=True, substring=True))
+    # bank statement style: the keyword is somewhere inside a longer line, so no exact match
+    lines = [f'CARD PAYMENT {i:08} {d.upper()} BERLIN DE' for i, d in enumerate(descriptions)]
+    bench.run('autocategorize_many 10k bank lines, substring',
+              lambda: utils.autocategorize_many(lines, ignore_case=True, substring=True))
+
+    cat_id = catmod.find_category_by_name(ledger['sample_category'])['id']
+    names = itertools.cycle([ledger['sample_category'] + ' (renamed)', ledger['sample_category']])
+    bench.run('category rename', lambda: catmod.update_category_name(cat_id, next(names)))
+    bench.run('list_categories_with_ids cold', catmod.list_categories_with_ids, setup=catmod.invalidate_categories)
+
+def analytics_cases(bench, client, ledger):
+    from backend import analytics
+    from benchmarks import analytics_sql
+    from backend import utils
+
+    year = int(ledger['last_day'][:4])
+    month = int(ledger['last_day'][5:7])
+    ranges = {'month': utils.get_date_range(year, month), 'year': utils.get_date_range(year), 'all': (None, None)}
+    for label, (start, end) in ranges.items():
+        if start is None:
+            where, params = 'WHERE 1=1', ()
+        else:
+            since = (datetime.date.fromisoformat(start) - datetime.timedelta(days=analytics.LOOKBACK_DAYS)).isoformat()
+            where, params = 'WHERE 1=1 AND date >= ? AND date < ?', (since, end)
+        bench.run(f'analytics pandas {label}', lambda: analytics.compute(analytics.load_ledger(where, params), start, end))
+        bench.run(f'analytics sql {label}', lambda: analytics_sql.compute(start, end))
+    bench.run('analytics pandas load_ledger all', lambda: analytics.load_ledger())
+    bench.run('GET /analytics/data all (cached)', _get(client, '/analytics/data?time=all'))
+
+def rate_cases(bench, stub):
+    from backend import db as dbmod
+    from backend import rates
+
+    rates.JSDELIVR = rates.PAGES_DEV = stub.url_template
+    days = [f'2020-{m:02d}-{d:02d}' for m in range(1, 13) for d in range(1, 29)]
+
+    def clear_rates():
+        rates._lru.clear()
+        with dbmod.get_conn(rates.RATES_DB_PATH) as conn:
+            conn.execute('DELETE FROM fx_rates')
+            conn.commit()
+
+    bench.run('rates.convert cold x50', lambda: [rates.convert(10.0, 'usd', 'eur', d) for d in days[:50]], setup=clear_rates)
+    bench.run('rates.convert warm x1000', lambda: [rates.convert(10.0, 'usd', 'eur', days[i % 50]) for i in range(1000)])
+    bench.run(f'rates.prefetch {len(days)} days cold', lambda: rates.prefetch([('usd', d) for d in days]), setup=clear_rates)
+
+    def clear_lru():
+        rates._lru.clear()
+    bench.run('rates.get_cached_rates from store x50', lambda: [rates.get_cached_rates('usd', d) for d in days[:50]], setup=clear_lru)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='10k', help='ledger size: ' + ', '.join(['10k', '100k', '1m']))
+    parser.add_argument('--rows', type=int, default=None, help='exact number of transactions (overrides --size)')
+    parser.add_argument('--categories', type=int, default=300)
+    parser.add_argument('--automations', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', default=None, help='run only benchmarks whose name contains this')
+    parser.add_argument('--rate-delay', type=float, default=0.0, help='seconds the stub waits per request')
+    parser.add_argument('--out', default=None, help='write the json here instead of stdout')
+    args = parser.parse_args()
+
+    from benchmarks.ledger import SIZES, generate
+    from benchmarks import stub_rates
+
+    rows = args.rows or SIZES[args.size.lower()]
+    out_path = os.path.abspath(args.out) if args.out else None
+    os.environ.pop('SYNC_DOWNLOAD_SCRIPT', None)
+    os.environ.setdefault('FLASK_SECRET', 'benchmark')
+
+    with tempfile.TemporaryDirectory(prefix='expense-bench-') as tmp:
+        # all data paths are relative (data/...), so the whole run stays inside tmp
+        os.chdir(tmp)
+        sys.path.insert(0, ROOT)
+        import app as appmod
+
+        appmod._init_database()
+        print(f'generating {rows} transactions ...', file=sys.stderr)
+        ledger = generate(rows, categories=args.categories, automations=args.automations)
+
+        flask_app = appmod.create_app({'START_SCHEDULER': False})
+        appmod.wait_until_ready()
+        client = flask_app.test_client()
+
+        bench = Bench(args.repeat, args.only)
+        t0 = time.perf_counter()
+        from backend import automations as auto_mod
+        auto_mod.update_fix_transactions()
+        ledger['automations_first_run_s'] = round(time.perf_counter() - t0, 3)
+
+        route_cases(bench, client, ledger)
+        backend_cases(bench, ledger)
+        analytics_cases(bench, client, ledger)
+        stub = stub_rates.start(args.rate_delay)
+        rate_cases(bench, stub)
+        stub.shutdown()
+
+        from backend import db as dbmod
+        dbmod.close_all_conns()
+        os.chdir(ROOT)
+
+    report = {
+        'commit': _commit(),
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'repeat': args.repeat,
+        'ledger': ledger,
+        'results': bench.results,
+    }
+    text = json.dumps(report, indent=2)
+    if out_path:
+        with open(out_path, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+startup time of the app, to catch regressions.
+
+measures in a fresh interpreter (and a temporary working directory, so the real
+data/ folder is not touched):
+  import_s         python -c 'import app'
+  create_app_s     create_app() after the import
+  first_request_s  create_app() until GET / answered (includes waiting for the readiness gate)
+
+usage: python benchmarks/startup.py [--runs 5] [--download-script path/to/slow_download.sh]
+prints one json object with the median and all runs
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+flask_app = app.create_app()
+t2 = time.perf_counter()
+status = flask_app.test_client().get('/').status_code
+t3 = time.perf_counter()
+print(json.dumps({'import_s': t1 - t0, 'create_app_s': t2 - t1, 'first_request_s': t3 - t1, 'status': status}))
+"""
+
+def run_once(download_script=None):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    env['FLASK_SECRET'] = env.get('FLASK_SECRET', 'benchmark')
+    env.pop('SYNC_DOWNLOAD_SCRIPT', None)
+    if download_script:
+        env['SYNC_DOWNLOAD_SCRIPT'] = os.path.abspath(download_script)
+    with tempfile.TemporaryDirectory() as cwd:
+        out = subprocess.run([sys.executable, '-c', PROBE], cwd=cwd, env=env,
+                             capture_output=True, text=True, check=True)
+    # the app prints startup messages, the measurement is the last line
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--download-script', default=None, help='run this as SYNC_DOWNLOAD_SCRIPT during startup')
+    args = parser.parse_args()
+
+    runs = [run_once(args.download_script) for _ in range(args.runs)]
+    report = {'runs': runs, 'python': sys.version.split()[0]}
+    for key in ('import_s', 'create_app_s', 'first_request_s'):
+        report[key + '_median'] = round(statistics.median(r[key] for r in runs), 4)
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
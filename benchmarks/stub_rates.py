@@ -0,0 +1,43 @@
+"""
+local stand-in for the currency api, so rate benchmarks don't depend on the network.
+answers /<date>/<base>.json with a fixed set of rates, optionally after a delay
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUOTES = ['eur', 'usd', 'gbp', 'chf', 'jpy', 'sek', 'nok', 'dkk', 'pln', 'czk']
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real cdn
+    disable_nagle_algorithm = True  # headers and body are separate writes, don't wait for acks
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or not parts[1].endswith('.json'):
+            self.send_error(404)
+            return
+        date_str, base = parts[0], parts[1][:-len('.json')]
+        if self.server.delay:
+            threading.Event().wait(self.server.delay)
+        self.server.requests += 1
+        rates = {q: (1.0 if q == base else round(0.5 + i * 0.25, 4)) for i, q in enumerate(QUOTES)}
+        body = json.dumps({'date': date_str, base: rates}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start(delay=0.0):
+    """start the stub in a daemon thread, returns the server (url template in server.url_template)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.requests = 0
+    server.url_template = f'http://127.0.0.1:{server.server_port}/{{date}}/{{base}}.json'
+    threading.Thread(target=server.serve_forever, name='stub-rates', daemon=True).start()
+    return server
@@ -0,0 +1,145 @@
+"""
+end to end check of the change-log sync with two local databases.
+
+device A gets a synthetic ledger and sends it to the empty device B. then both
+edit the same rows (an update on each side, an update against a later delete,
+the same new category, new rows on both), exchange changesets in both
+directions and must end up with the same rows. prints the changeset sizes next
+to the database file and exits with 1 if the devices differ.
+
+usage:
+  python -m benchmarks.sync_changes
+  python -m benchmarks.sync_changes --rows 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _use(path):
+    from backend import categories as catmod
+    from backend import db as dbmod
+    dbmod.configure(db_path=path)
+    catmod.invalidate_categories()
+
+def _rows():
+    """every row by (table, uid), with references as uids, so two devices can be compared"""
+    from backend import changelog
+    return {(c['table'], c['uid']): c['row'] for c in changelog.export_changes(since=0)['changes'] if c['op'] == 'upsert'}
+
+def _id(uid):
+    from backend import db as dbmod
+    with dbmod.get_conn() as conn:
+        return conn.execute('SELECT id FROM expenses WHERE uid = ?', (uid,)).fetchone()['id']
+
+def _send(src, dst, path, peer):
+    """export on src for peer, apply on dst. returns (number of changes, apply report)"""
+    from backend import changelog
+    _use(src)
+    started = time.perf_counter()
+    changeset = changelog.export_changes(peer)
+    changelog.write_changeset(path, changeset)
+    exported = time.perf_counter() - started
+    _use(dst)
+    started = time.perf_counter()
+    report = changelog.apply_changes(changelog.read_changeset(path))
+    print(f"  {len(changeset['changes'])} changes, {os.path.getsize(path) / 1024:.1f} KiB, "
+          f"export {exported:.2f}s, apply {time.perf_counter() - started:.2f}s, applied {report['applied']}, "
+          f"skipped {report['skipped']}, conflicts {len(report['conflicts'])}")
+    return len(changeset['changes']), report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+
+    from benchmarks.ledger import generate
+    os.environ.pop('SYNC_DOWNLOAD_SCRIPT', None)
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='expense-sync-') as tmp:
+        os.chdir(tmp)
+        sys.path.insert(0, ROOT)
+        import app as appmod
+        from backend import automations as auto_mod
+        from backend import categories as catmod
+        from backend import changelog
+        from backend import db as dbmod
+
+        a, b = os.path.join(tmp, 'a', 'expenses_tracker.db'), os.path.join(tmp, 'b', 'expenses_tracker.db')
+        changes = os.path.join(tmp, 'changes.json.gz')
+        _use(a)
+        appmod._init_database()
+        generate(args.rows)
+        auto_mod.update_fix_transactions()
+        a_id = changelog.device_id()
+        _use(b)
+        appmod._init_database()
+        b_id = changelog.device_id()
+        _use(a)
+        dbmod.checkpoint()
+        print(f'database file: {os.path.getsize(a) / 1024:.1f} KiB')
+
+        print('initial sync A -> B')
+        _send(a, b, changes, b_id)
+        _use(a)
+        before = _rows()
+        _use(b)
+        # the automations run on B too: it generates the rows A already sent, under the same uids
+        auto_mod.update_fix_transactions()
+        if _rows() != before:
+            failures.append('B differs from A after the initial sync')
+
+        # concurrent edits: the later one wins per row
+        uids = sorted(uid for table, uid in before if table == 'expenses' and '/' not in uid)
+        edited, deleted = uids[0], uids[1]
+        _use(a)
+        dbmod.update_transaction(_id(edited), '2020-01-01', 'edited on A', -1.5, None, 1)
+        time.sleep(0.01)
+        _use(b)
+        dbmod.update_transaction(_id(deleted), '2020-01-02', 'edited on B', -2.5, None, 1)
+        catmod.add_category('added on both')
+        time.sleep(0.01)
+        dbmod.update_transaction(_id(edited), '2020-01-03', 'edited on B later', -3.5, None, 1)
+        dbmod.insert_transaction('2020-01-04', 'added on B', -4.5, catmod.add_category('added on both'))
+        time.sleep(0.01)
+        _use(a)
+        dbmod.delete_transaction(_id(deleted))
+        dbmod.insert_transaction('2020-01-05', 'added on A', -5.5, catmod.add_category('added on both'))
+
+        print('B -> A')
+        _send(b, a, changes, a_id)
+        print('A -> B')
+        _send(a, b, changes, b_id)
+        _use(a)
+        after = _rows()
+        _use(b)
+        if _rows() != after:
+            failures.append('A and B differ after the exchange')
+        if after.get(('expenses', edited), {}).get('description') != 'edited on B later':
+            failures.append('the later update did not win')
+        if ('expenses', deleted) in after:
+            failures.append('the later delete did not win')
+        if len([k for k in after if k[0] == 'categories' and after[k]['name'] == 'added on both']) != 1:
+            failures.append('the category added on both devices is not one row')
+        if not {r['description'] for r in after.values() if 'description' in r} >= {'added on A', 'added on B'}:
+            failures.append('a new row is missing')
+
+        print('B -> A, nothing new')
+        n, _ = _send(b, a, changes, a_id)
+        if n:
+            failures.append(f'{n} changes sent again')
+
+        dbmod.close_all_conns()
+        os.chdir(ROOT)
+
+    for f in failures:
+        print('FAIL ' + f)
+    print('devices converged' if not failures else f'{len(failures)} problems')
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()